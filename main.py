@@ -11,6 +11,7 @@ from tornado.web import Application
 
 from napoleon.wsgi import application
 from main_tornado import make_rootings, parse
+from napoleon.game.metrics import instrument
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +39,8 @@ if __name__ == "__main__":
 
     # after loading wsgi_app
     parse()
+    if settings.REDIS_METRICS:
+        instrument()
 
     # use PORT env variable on heroku
     port = int(os.environ.get("PORT", options.port))
@@ -9,7 +9,8 @@ from tornado.options import options, define, parse_command_line
 from tornado.web import Application, FallbackHandler
 from tornado.log import enable_pretty_logging
 
-from napoleon.game.handler import GameHandler
+from napoleon.game.handler import GameHandler, MetricsHandler
+from napoleon.game.metrics import instrument
 from napoleon.chat.handler import ChatHandler
 
 logger = logging.getLogger(__name__)
@@ -24,6 +25,12 @@ tornado depends on only a django setting file.
     python main_tornado.py
     python manage.py runserver 0.0.0.0:8000 --noreload --settings=napoleon.settings.local
 
+The processes share the rooms over redis pub/sub,
+so you can run as many as you like behind a load balancer ::
+
+    python main_tornado.py --port=8001
+    python main_tornado.py --port=8002
+
 """
 
 
@@ -43,6 +50,8 @@ def make_rootings(fallback_handler=None):
         (r"/ws/(?P<room_id>\w+)", GameHandler),
         (r"/chat/(?P<room_id>\w+)", ChatHandler),
     ]
+    if settings.REDIS_METRICS:
+        rootings.append((r"/metrics", MetricsHandler))
     if fallback_handler:
         rootings.append((r".*", FallbackHandler, {"fallback": fallback_handler}))
 
@@ -53,6 +62,8 @@ if __name__ == "__main__":
     setup()
 
     parse()
+    if settings.REDIS_METRICS:
+        instrument()
     app = Application(make_rootings(), debug=settings.DEBUG)
     app.listen(options.port)
 
@@ -1,5 +1,8 @@
 
 
+from napoleon.game import card
+
+
 class BaseAI(object):
 
     def __init__(self, player):
@@ -14,17 +17,35 @@ class BaseAI(object):
         """
         # 各メソッドはオーバーライドさせるが、
         # 子供の戻り値は信用しない。値のチェックが必要
-        if self.phase.current == "declare":
+        if self.phase.current is None:
+            # nobody starts a room of AIs
+            if self.is_all_AIs and self.phase.is_appropriate_player_number:
+                return {"action": "start"}
+        elif self.phase.current == "declare":
             if not self.player.is_passed:
                 declaration = self.declare()
+                if declaration is None and self.is_all_AIs and self.is_last_to_declare:
+                    # otherwise the cards are dealt again forever
+                    declaration = self.least_declaration()
                 if declaration is None:
                     return {"action": "pass"}
                 else:
-                    return {"action": "declare", "declaration": declaration}
+                    return {"action": "declare", "declaration": int(declaration)}
         elif self.phase.current == "adjutant":
-            pass
+            if self.player.is_napoleon:
+                adjutant = self.decide()
+                if adjutant is None and self.is_all_AIs:
+                    # nobody else can go on with a room of AIs
+                    adjutant = self.first_absent_card()
+                if adjutant is not None:
+                    return {"action": "adjutant", "adjutant": int(adjutant)}
         elif self.phase.current == "discard":
-            pass
+            if self.player.is_napoleon:
+                unused = self.discard()
+                if unused is None and self.is_all_AIs:
+                    unused = self.plain_cards()
+                if unused is not None:
+                    return {"action": "discard", "unused": [int(c) for c in unused]}
         elif self.phase.current in ["first_round", "rounds"]:
             if self.player == self.state.turn:
                 selected = self.select()
@@ -35,6 +56,38 @@ class BaseAI(object):
 
         return None
 
+    @property
+    def is_all_AIs(self):
+        return all(p.is_AI for p in self.state.players)
+
+    @property
+    def is_last_to_declare(self):
+        return not self.state.napoleon and len(self.state._passed_players) == len(self.state.players) - 1
+
+    def least_declaration(self):
+        """
+        :return: the least declaration of the suit which the player has most
+        """
+        hand = card.CardSet(self.player.hand)
+        suit = max(card.Suit, key=lambda s: len(hand.of_suit(s)))
+        return card.Declaration(13, suit)
+
+    def first_absent_card(self):
+        """
+        :return: the strongest card which the player doesn't have
+        """
+        hand = card.CardSet(self.player.hand)
+        for c in [card.ALMIGHTY, card.Joker.red, card.Joker.black] + list(card.deck):
+            if c not in hand:
+                return c
+
+    def plain_cards(self):
+        """
+        :return: as many cards as the rest, plain cards rather than face cards
+        """
+        cards = sorted(self.player.hand, key=lambda c: c.is_faced)
+        return cards[:len(self.state.rest)]
+
     def to_json(self):
         return {"name": self.__class__.name}
 
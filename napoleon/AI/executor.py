@@ -0,0 +1,172 @@
+"""
+Decisions of AI players out of the IOLoop.
+
+An AI class decides on the IOLoop while its decisions fit in a budget.
+Once a decision exceeds it, the class decides in a process pool
+with what the player can see, and gets a fallback move on a timeout:
+
+    user_id, json = await executor.next_action(state)
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from napoleon.game import card
+from napoleon.game.engine import GameEngine
+from napoleon.game.state import Role
+
+
+logger = logging.getLogger(__name__)
+
+
+def _values(cards):
+    return [int(c) for c in cards]
+
+
+def view(state, user_id):
+    """
+    :return: what a player can see, which can be sent to another process
+    """
+    me = state.create_player(user_id)
+    is_napoleon = me.is_napoleon
+    return {
+        "players": [{
+            "user_id": p.user_id,
+            "is_AI": p.is_AI,
+            "hand": _values(p.hand) if p.user_id == user_id else [],
+            "face": p.face,
+            "role": p.role and p.role.value,
+            "is_passed": p.is_passed,
+        } for p in state.players],
+        "phase": state.phase.current,
+        "waiting_next_turn": state.phase.waiting_next_turn,
+        "declaration": state.declaration and int(state.declaration),
+        "napoleon": state.napoleon,
+        "adjutant": state.adjutant and int(state.adjutant),
+        "turn": state.turn_user_id,
+        "board": _values(state.board),
+        "player_cards": {k: int(v) for k, v in state.player_cards.items()},
+        "rest": _values(state.rest) if is_napoleon else [],
+        "unused": _values(state.unused) if is_napoleon else [],
+    }
+
+
+def to_engine(view, user_id, AI_name):
+    """
+    :return: a GameEngine of view where only the player has an AI.
+             The hands of the others are empty.
+    """
+    engine = GameEngine([p["user_id"] for p in view["players"]], {user_id: AI_name})
+    engine.phase.current = view["phase"]
+    engine.phase.waiting_next_turn = view["waiting_next_turn"]
+    for p, v in zip(engine.players, view["players"]):
+        p.is_AI = v["is_AI"]
+        p.hand = card.from_list(v["hand"])
+        p.face = v["face"]
+        p.role = v["role"] and Role(v["role"])
+        if v["is_passed"]:
+            p.pass_()
+    if view["declaration"]:
+        engine.declaration = view["declaration"]
+    if view["napoleon"]:
+        engine.napoleon = view["napoleon"]
+    if view["adjutant"]:
+        engine.adjutant = view["adjutant"]
+    if view["turn"]:
+        engine.turn = view["turn"]
+    # the lead is the last
+    engine._board = card.from_list(view["board"])
+    engine._player_cards = {k: card.from_int(v) for k, v in view["player_cards"].items()}
+    engine.rest = card.from_list(view["rest"])
+    engine.unused = card.from_list(view["unused"])
+    return engine
+
+
+def decide(view, user_id, AI_name):
+    """
+    Runs in a worker process
+    :return: (json, CPU seconds)
+    """
+    start = time.process_time()
+    json = to_engine(view, user_id, AI_name).create_player(user_id)._AI.get_action()
+    return json, time.process_time() - start
+
+
+def fallback(player):
+    """
+    :return: a move which is decided at once
+    """
+    from napoleon.AI import RandomMan
+    return RandomMan(player).get_action()
+
+
+class Executor(object):
+    """
+    :budget: CPU seconds of a decision on the IOLoop. settings.AI_DECISION_BUDGET by default
+    :timeout: seconds to wait for a process. settings.AI_DECISION_TIMEOUT by default
+    :processes: the number of processes. settings.AI_PROCESSES by default
+    """
+
+    def __init__(self, budget=None, timeout=None, processes=None):
+        self._budget = budget
+        self._timeout = timeout
+        self._processes = processes
+        self.pool = None
+        # the names of AI classes which exceed the budget
+        self.heavy = set()
+
+    @property
+    def budget(self):
+        return settings.AI_DECISION_BUDGET if self._budget is None else self._budget
+
+    @property
+    def timeout(self):
+        return settings.AI_DECISION_TIMEOUT if self._timeout is None else self._timeout
+
+    def is_heavy(self, player):
+        return player._AI.__class__.__name__ in self.heavy
+
+    async def get_action(self, player):
+        """
+        :return: the action of an AI player
+        """
+        name = player._AI.__class__.__name__
+        if name not in self.heavy:
+            start = time.process_time()
+            json = player._AI.get_action()
+            if time.process_time() - start > self.budget:
+                logger.info("%s exceeds the budget of a decision" % name)
+                self.heavy.add(name)
+            return json
+
+        if self.pool is None:
+            processes = settings.AI_PROCESSES if self._processes is None else self._processes
+            self.pool = ProcessPoolExecutor(max_workers=processes)
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self.pool, decide, view(player.state, player.user_id), player.user_id, name)
+        try:
+            json, seconds = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning("%s doesn't decide in time, so a fallback is taken" % name)
+            return fallback(player)
+        except Exception:
+            logger.exception("%s fails to decide, so a fallback is taken" % name)
+            return fallback(player)
+        if seconds <= self.budget:
+            self.heavy.discard(name)
+        return json
+
+    async def next_action(self, state):
+        """
+        :return: (user_id, json) of the first AI player which has an action, or None
+        """
+        for player in state.player_AIs:
+            json = await self.get_action(player)
+            if json:
+                return player.user_id, json
+
+
+executor = Executor()
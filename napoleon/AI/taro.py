@@ -16,7 +16,7 @@ class Taro(BaseAI):
 
             # same 2
             for c in cards:
-                if c in list(cards.Joker):
+                if c in list(card.Joker):
                     continue
                 if c.pip == 2:
                     return c
@@ -1,9 +1,7 @@
 from django.conf import settings
+from tornado import gen
 from tornado.websocket import WebSocketHandler
 from napoleon.game.handler import WSHandlerMixin
-from napoleon.game.adaptor import RedisAdaptor
-from napoleon.game import state
-from napoleon.game import session
 
 
 class Chat(object):
@@ -11,26 +9,29 @@ class Chat(object):
     def __init__(self, adaptor):
         self.adaptor = adaptor
 
-    def set(self, msg, user_id):
-        self.adaptor.set_list("chat_user_ids", user_id, delete=False, unique=False)
-        self.adaptor.set_list("chat_messages", msg, delete=False, unique=False)
-        self.adaptor.expire(["chat_user_ids", "chat_messages"], settings.REDIS_CHAT_EXPRITE_TIME)
+    async def set(self, msg, user_id):
+        await self.adaptor.set_list("chat_user_ids", user_id, delete=False, unique=False)
+        await self.adaptor.set_list("chat_messages", msg, delete=False, unique=False)
+        await self.adaptor.expire(["chat_user_ids", "chat_messages"], settings.REDIS_CHAT_EXPRITE_TIME)
 
-    def get(self):
-        ids = self.adaptor.get_list("chat_user_ids")
-        msg = self.adaptor.get_list("chat_messages")
+    async def get(self):
+        ids = await self.adaptor.get_list("chat_user_ids")
+        msg = await self.adaptor.get_list("chat_messages")
         users = {}
+        messages = []
         for i, m in zip(ids, msg):
             if i not in users:
-                a = RedisAdaptor(self.adaptor.room_id, i, self.adaptor.conn)
-                users[i] = a.get_dict("user")
+                a = self.adaptor.with_user(i)
+                users[i] = await a.get_dict("user")
             d = {"msg": m}
             d.update(users[i])
-            yield d
+            messages.append(d)
+        return messages
 
 
 class ChatHandler(WSHandlerMixin, WebSocketHandler):
 
+    @gen.coroutine
     def on_message(self, message):
         try:
             json = self.to_json(message)
@@ -38,15 +39,14 @@ class ChatHandler(WSHandlerMixin, WebSocketHandler):
             return
 
         sid = json.pop("session_id")
-        try:
-            uid = session.get_user_id(self.adaptor, session_id=sid)
-        except state.InvalidSession:
+        uid = yield self.find_user_id(sid)
+        if uid is None:
             return self.close()
 
         chat = Chat(self.adaptor)
         msg = json.get("msg")
         if msg:
-            chat.set(msg, uid)
+            yield chat.set(msg, uid)
 
-        messages = list(chat.get())[:settings.REDIS_CHAT_LENGTH]
-        self.write_on_same_room({"messages": messages})
+        messages = (yield chat.get())[:settings.REDIS_CHAT_LENGTH]
+        yield self.write_on_same_room({"messages": messages})
@@ -1,45 +1,67 @@
+import contextlib
+import json
 import logging
+import time
 from django.conf import settings
+from redis import WatchError
+
+from napoleon.game.scripts import get_scripts
 
 
 logger = logging.getLogger(__name__)
 
 
+# name: (key format, redis type)
+KEYS = {
+    "phase": ("{room_id}_phase", "string"),
+    "napoleon": ("{room_id}_napoleon", "string"),
+    "player_ids": ("{room_id}_player_ids", "list"),
+    "pass_ids": ("{room_id}_pass_ids", "list"),
+    "declaration": ("{room_id}_declaration", "string"),  # int (winning_number, trump suit)
+    "turn": ("{room_id}_turn", "string"),
+    "board": ("{room_id}_board", "list"),
+    "adjutant": ("{room_id}_adjutant", "string"),
+    "unused": ("{room_id}_unused", "list"),
+    "face": ("{room_id}_{user_id}_face", "string"),
+    "player_cards": ("{room_id}_player_cards", "hash"),  # (int user_id: int card.value)
+    "waiting_next_turn": ("{room_id}_waiting_next_turn", "string"),  # bool
+    "role": ("{room_id}_{user_id}_role", "string"),  # (0: napo, 1:rengo)
+    "rest": ("{room_id}_rest", "list"),
+    "hand": ("{room_id}_{user_id}_hand", "list"),
+    "map": ("{room_id}_map", "hash"),  # (user_id: session_id)
+    "sessions": ("{room_id}_sessions", "hash"),  # (session_id: user_id) the reverse of map
+    "version": ("{room_id}_version", "string"),  # int incremented on every commit
+
+    # user
+    "user": ("user_{user_id}", "hash"),
+    "isAI": ("{room_id}_isAI", "hash"),  # (user_id: bool)
+
+    # ai
+    "AI": ("{room_id}_{user_id}_AI", "hash"),  # (int user_id: str name)
+
+    # chat
+    "chat_user_ids": ("{room_id}_chat_user_ids", "list"),
+    "chat_messages": ("{room_id}_chat_messages", "list"),
+}
+
+USER_KEYS = [k for k, (fmt, _) in KEYS.items() if "{user_id}" in fmt]
+ROOM_KEYS = [k for k in KEYS if k not in USER_KEYS]
+
+# a set of user ids who have had keys in a room, so that the keys are known without KEYS
+MEMBERS_KEY = "{room_id}_members"
+
+
 def get_key(key, room_id, user_id=None):
-    fmt = {
-        "phase": "{room_id}_phase",  # value
-        "napoleon": "{room_id}_napoleon",  # value
-        "player_ids": "{room_id}_player_ids",  # sorted set
-        "pass_ids": "{room_id}_pass_ids",  # set
-        "declaration": "{room_id}_declaration",  # int (winning_number, trump suit)
-        "turn": "{room_id}_turn",  # value
-        "board": "{room_id}_board",  # list
-        "adjutant": "{room_id}_adjutant",  # hash
-        "unused": "{room_id}_unused",  # list
-        "face": "{room_id}_{user_id}_face",  # value
-        "player_cards": "{room_id}_player_cards",  # hash (int user_id: int card.value)
-        "waiting_next_turn": "{room_id}_waiting_next_turn",  # bool
-        "role": "{room_id}_{user_id}_role",  # value (0: napo, 1:rengo)
-        "rest": "{room_id}_rest",  # list
-        "hand": "{room_id}_{user_id}_hand",  # list
-        "map": "{room_id}_map",  # hash
-
-        # user
-        "user": "user_{user_id}",  # hash
-        "isAI": "{room_id}_isAI",  # value (bool)
-
-        # ai
-        "AI": "{room_id}_{user_id}_AI",  # hash (int user_id: str name)
-
-        # chat
-        "chat_user_ids": "{room_id}_chat_user_ids",  # list
-        "chat_messages": "{room_id}_chat_messages",  # list
-
-    }
     if key in ["role", "hand", "user"] and user_id is None:
         raise ValueError("You must take user_id as an argument when key is role or hand.")
 
-    return fmt[key].format(**locals())
+    return KEYS[key][0].format(room_id=room_id, user_id=user_id)
+
+
+class ConflictError(Exception):
+    """
+    Another process has changed a room since a snapshot was loaded
+    """
 
 
 def decode(s, type=None):
@@ -69,6 +91,8 @@ def decode(s, type=None):
 
 class RedisAdaptor(object):
 
+    is_snapshot = False
+
     def __init__(self, room_id, user_id=None, conn=None, timer=None):
         self.conn = conn or settings.REDIS_CONNECTION
         self.room_id = room_id
@@ -77,13 +101,24 @@ class RedisAdaptor(object):
 
     @classmethod
     def create(cls, adaptor, user_id):
+        return adaptor.with_user(user_id)
+
+    def with_user(self, user_id):
         return RedisAdaptor(
-            room_id=adaptor.room_id,
+            room_id=self.room_id,
             user_id=user_id,
-            conn=adaptor.conn,
-            timer=adaptor.timer,
+            conn=self.conn,
+            timer=self.timer,
         )
 
+    def snapshot(self):
+        """
+        :return: a SnapshotAdaptor which has loaded all the keys of this room
+        """
+        adaptor = SnapshotAdaptor(self.room_id, self.user_id, self.conn, self.timer)
+        adaptor.load()
+        return adaptor
+
     def key(self, k):
         return get_key(k, room_id=self.room_id, user_id=self.user_id)
 
@@ -91,24 +126,27 @@ class RedisAdaptor(object):
         return decode(self.conn.lrange(self.key(key), 0, -1), type=type)
 
     def set_list(self, key, iterable, delete=True, unique=True):
-        bak = key
         key = self.key(key)
-        if delete:
-            self.conn.delete(key)
         if not isinstance(iterable, (list, tuple, set)):
-            # use a list as a unique container
-            # this code is not always perfect
-            if unique and str(iterable) in self.get_list(bak):
+            if unique:
+                # use a list as a unique container
+                args = [iterable, int(delete), self.timer or 0]
+                self.scripts.push_unique(keys=[key], args=args, client=self.conn)
                 return
             iterable = [iterable]
-        for i in iterable:
-            self.conn.lpush(key, i)
-
+        pipe = self._pipeline()
+        if delete:
+            pipe.delete(key)
+        if iterable:
+            # the same order as pushing them one by one
+            pipe.lpush(key, *iterable)
         if self.timer:
-            self.expire(bak, self.timer)
+            self._expire_in(pipe, key, self.timer)
+        self._execute(pipe)
 
     def rem_list(self, key, value):
-        self.conn.lrem(self.key(key), value, 0)
+        # count 0 removes all the values
+        self.conn.lrem(self.key(key), 0, value)
 
     def get(self, key, type=None):
         return decode(self.conn.get(self.key(key)), type=type)
@@ -121,6 +159,9 @@ class RedisAdaptor(object):
     def get_dict(self, key, type=None):
         return decode(self.conn.hgetall(self.key(key)), type=type)
 
+    def get_dict_item(self, key, k, type=None):
+        return decode(self.conn.hget(self.key(key), k), type=type)
+
     def set_dict(self, key, k, v):
         self.conn.hset(self.key(key), k, v)
         if self.timer:
@@ -129,6 +170,12 @@ class RedisAdaptor(object):
     def rem_dict(self, key, k):
         self.conn.hdel(self.key(key), k)
 
+    def incr(self, key, n=1):
+        value = self.conn.incr(self.key(key), n)
+        if self.timer:
+            self.expire(key, self.timer)
+        return value
+
     def delete(self, key):
         self.conn.delete(self.key(key))
 
@@ -138,8 +185,889 @@ class RedisAdaptor(object):
         for k in key:
             self.conn.expire(self.key(k), sec)
 
+    def _pipeline(self):
+        return self.conn.pipeline(transaction=True)
+
+    def _expire_in(self, pipe, key, sec):
+        pipe.expire(key, sec)
+
+    def _execute(self, pipe):
+        pipe.execute()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Queue the writes in one MULTI/EXEC which is sent on exit.
+        The values can't be read in the context.
+        :return: a BatchAdaptor of this room
+        """
+        pipe = self.conn.pipeline(transaction=True)
+        adaptor = BatchAdaptor(self.room_id, self.user_id, pipe, self.timer, scripts=self.scripts)
+        yield adaptor
+        for key, sec in adaptor.expires.items():
+            pipe.expire(key, sec)
+        pipe.execute()
+
+    def register(self):
+        """
+        Register the user as a member so that flush() deletes the keys of the user
+        """
+        key = MEMBERS_KEY.format(room_id=self.room_id)
+        self.conn.sadd(key, self.user_id)
+        if self.timer:
+            self.conn.expire(key, self.timer)
+
+    def room_keys(self):
+        """
+        :return: all the keys of this room (a user key is shared among rooms)
+        """
+        pipe = self.conn.pipeline(transaction=False)
+        return self._room_keys(pipe.execute() if self._members(pipe) else [])
+
+    def _members(self, pipe):
+        """
+        Queue the commands to find the users who have keys in this room.
+        :return: False if no command is needed
+        """
+        pipe.smembers(MEMBERS_KEY.format(room_id=self.room_id))
+        pipe.lrange(get_key("player_ids", self.room_id), 0, -1)
+        return True
+
+    def _room_keys(self, members):
+        user_ids = set()
+        for ids in members:
+            user_ids.update(decode(ids))
+        keys = [get_key(k, self.room_id) for k in ROOM_KEYS]
+        for uid in user_ids:
+            keys += [get_key(k, self.room_id, uid) for k in USER_KEYS if k != "user"]
+        return keys + [MEMBERS_KEY.format(room_id=self.room_id)]
+
+    def flush(self):
+        self.conn.unlink(*self.room_keys())
+
+    @property
+    def scripts(self):
+        return get_scripts(self.conn)
+
+
+class BatchAdaptor(RedisAdaptor):
+    """
+    Queues the writes in the pipeline of RedisAdaptor.batch.
+    A key written several times expires once when the pipeline is sent.
+    """
+
+    def __init__(self, room_id, user_id=None, conn=None, timer=None, scripts=None, expires=None):
+        super().__init__(room_id, user_id, conn, timer)
+        # the scripts are registered on the connection, not on the pipeline
+        self._scripts = scripts
+        # {key: seconds} shared by the adaptors of the batch
+        self.expires = {} if expires is None else expires
+
+    def with_user(self, user_id):
+        return BatchAdaptor(self.room_id, user_id, self.conn, self.timer, self._scripts, self.expires)
+
+    @property
+    def scripts(self):
+        return self._scripts
+
+    def _pipeline(self):
+        return self.conn
+
+    def _expire_in(self, pipe, key, sec):
+        self.expires[key] = sec
+
+    def _execute(self, pipe):
+        # sent on exit of the batch
+        pass
+
+    def expire(self, key, sec):
+        if not isinstance(key, (list, set)):
+            key = [key]
+        for k in key:
+            self.expires[self.key(k)] = sec
+
+    @contextlib.contextmanager
+    def batch(self):
+        yield self
+
+
+class Snapshot(object):
+    """
+    Values of redis keys shared by the snapshot adaptors of one room.
+    A value is the same as redis-py returns: bytes, a list or a dict of bytes.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.dirty = set()
+        self.expires = {}
+        # the version when loaded
+        self.version = None
+        # {key: {type: a decoded value}} dropped when the key is written
+        self.decoded = {}
+
+
+class MemoryStore(object):
+    """
+    Values of a process in place of redis, which MemoryAdaptor reads and writes.
+    A value is kept raw as Snapshot does, and a key expires as redis does.
+    """
+
+    def __init__(self):
+        self.data = {}
+        # {key: time.monotonic() when the key expires}
+        self.deadlines = {}
+        # {key: {type: a decoded value}} dropped when the key is written
+        self.decoded = {}
+
+    def _is_expired(self, key, now=None):
+        deadline = self.deadlines.get(key)
+        return deadline is not None and deadline <= (now or time.monotonic())
+
+    def get(self, key):
+        """
+        :return: a raw value or None
+        """
+        if self._is_expired(key):
+            self.delete(key)
+        return self.data.get(key)
+
+    def set(self, key, value):
+        """
+        An empty list or dict deletes the key as redis does, and the TTL is cleared
+        """
+        self.deadlines.pop(key, None)
+        self.decoded.pop(key, None)
+        if value is None or (isinstance(value, (list, dict, set)) and not value):
+            self.data.pop(key, None)
+        else:
+            self.data[key] = value
+
+    def expire(self, key, sec):
+        if key in self.data:
+            self.deadlines[key] = time.monotonic() + sec
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+            self.deadlines.pop(key, None)
+            self.decoded.pop(key, None)
+
+    unlink = delete
+
+    def sweep(self):
+        """
+        Delete the expired keys, which are otherwise deleted when they are read
+        """
+        now = time.monotonic()
+        self.delete(*[key for key in self.deadlines if self._is_expired(key, now)])
+
+
+# the rooms of this process with settings.REDIS_ROOM_LAYOUT = "memory"
+memory = MemoryStore()
+
+
+def _encode(value):
+    return str(value).encode("utf-8")
+
+
+def _fetch(conn, key, type):
+    if type == "list":
+        return conn.lrange(key, 0, -1)
+    elif type == "hash":
+        return conn.hgetall(key)
+    else:
+        return conn.get(key)
+
+
+def _pushed(value, iterable, unique=True):
+    """
+    :value: a raw list
+    :return: a raw list after LPUSH, or None if a unique value is already in it
+    """
+    value = list(value)
+    if not isinstance(iterable, (list, tuple, set)):
+        # use a list as a unique container
+        if unique and _encode(iterable) in value:
+            return None
+        iterable = [iterable]
+    for i in iterable:
+        value.insert(0, _encode(i))
+    return value
+
+
+def _removed(value, v):
+    v = _encode(v)
+    return [i for i in value if i != v]
+
+
+def _with_item(value, k, v):
+    value = dict(value)
+    value[_encode(k)] = _encode(v)
+    return value
+
+
+def _without_item(value, k):
+    value = dict(value)
+    value.pop(_encode(k), None)
+    return value
+
+
+def _run(steps):
+    """
+    Execute the pipelines which a generator yields and send the results back to it.
+    A loader is written as a generator so that it runs on a blocking or an async connection.
+    """
+    result = None
+    try:
+        while True:
+            result = steps.send(result).execute()
+    except StopIteration:
+        pass
+
+
+def _write_key(pipe, key, value, timer=None):
+    pipe.delete(key)
+    if isinstance(value, list):
+        if value:
+            pipe.rpush(key, *value)
+    elif isinstance(value, dict):
+        if value:
+            pipe.hset(key, mapping=value)
+    elif value is not None:
+        pipe.set(key, value)
+    if timer and value:
+        pipe.expire(key, timer)
+
+
+class StoreAdaptor(RedisAdaptor):
+    """
+    Implements the operations on raw values with _read and _write.
+    A raw value is the same as redis-py returns: bytes, a list or a dict of bytes.
+    """
+
+    def _read(self, key, type):
+        raise NotImplementedError
+
+    def _write(self, key, value):
+        raise NotImplementedError
+
+    def get_list(self, key, type=None):
+        return decode(list(self._read(self.key(key), "list")), type=type)
+
+    def set_list(self, key, iterable, delete=True, unique=True):
+        k = self.key(key)
+        value = _pushed([] if delete else self._read(k, "list"), iterable, unique)
+        if value is not None:
+            self._write(k, value)
+
+    def rem_list(self, key, value):
+        k = self.key(key)
+        self._write(k, _removed(self._read(k, "list"), value))
+
+    @contextlib.contextmanager
+    def batch(self):
+        # the writes go to the store, which a snapshot commits in one transaction
+        yield self
+
+    def get(self, key, type=None):
+        return decode(self._read(self.key(key), "string"), type=type)
+
+    def set(self, key, value):
+        self._write(self.key(key), _encode(value))
+
+    def get_dict(self, key, type=None):
+        return decode(dict(self._read(self.key(key), "hash")), type=type)
+
+    def get_dict_item(self, key, k, type=None):
+        return decode(self._read(self.key(key), "hash").get(_encode(k)), type=type)
+
+    def set_dict(self, key, k, v):
+        key = self.key(key)
+        self._write(key, _with_item(self._read(key, "hash"), k, v))
+
+    def rem_dict(self, key, k):
+        key = self.key(key)
+        self._write(key, _without_item(self._read(key, "hash"), k))
+
+    def incr(self, key, n=1):
+        key = self.key(key)
+        value = int(self._read(key, "string") or 0) + n
+        self._write(key, _encode(value))
+        return value
+
+    def delete(self, key):
+        self._write(self.key(key), None)
+
+
+class DecodeOnce(object):
+    """
+    Mixin which decodes a value only once until it is written.
+    self.store.decoded keeps {key: {type: a decoded value}}
+    """
+
+    def _decode(self, key, kind, type):
+        k = self.key(key)
+        value = self._read(k, kind)
+        decoded = self.store.decoded.setdefault(k, {})
+        if type not in decoded:
+            decoded[type] = decode(value, type=type)
+        return decoded[type]
+
+    def get_list(self, key, type=None):
+        return list(self._decode(key, "list", type))
+
+    def get(self, key, type=None):
+        return self._decode(key, "string", type)
+
+    def get_dict(self, key, type=None):
+        return dict(self._decode(key, "hash", type))
+
+    def get_dict_item(self, key, k, type=None):
+        return self._decode(key, "hash", type).get(str(k))
+
+
+class SnapshotAdaptor(DecodeOnce, StoreAdaptor):
+    """
+    Reads all the keys of a room with one pipeline and keeps them in memory.
+    Changes are written back by commit() in one MULTI/EXEC.
+    """
+
+    is_snapshot = True
+
+    def __init__(self, room_id, user_id=None, conn=None, timer=None, snapshot=None):
+        super().__init__(room_id, user_id, conn, timer)
+        self.store = snapshot or Snapshot()
+
+    def with_user(self, user_id):
+        return self.__class__(
+            room_id=self.room_id,
+            user_id=user_id,
+            conn=self.conn,
+            timer=self.timer,
+            snapshot=self.store,
+        )
+
+    def _keys(self, user_ids):
+        keys = [(get_key(k, self.room_id), KEYS[k][1]) for k in ROOM_KEYS]
+        for uid in user_ids:
+            keys += [(get_key(k, self.room_id, uid), KEYS[k][1]) for k in USER_KEYS]
+        return keys
+
+    def load(self):
+        _run(self._loader())
+
+    def _loader(self):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.lrange(get_key("player_ids", self.room_id), 0, -1)
+        user_ids = decode((yield pipe)[0])
+
+        keys = self._keys(user_ids)
+        pipe = self.conn.pipeline(transaction=False)
+        for key, type in keys:
+            _fetch(pipe, key, type)
+        values = yield pipe
+        self._loaded({key: value for (key, _), value in zip(keys, values)})
+
+    def _loaded(self, data):
+        self.store.data = data
+        self.store.dirty = set()
+        self.store.expires = {}
+        self.store.decoded = {}
+        self.store.version = data.get(self.key("version"))
+
+    def commit(self):
+        """
+        Write all the changed keys in one transaction and increment the version.
+        :raise ConflictError: if the version has changed since the snapshot was loaded
+        """
+        s = self.store
+        if not (s.dirty or s.expires):
+            return
+        pipe = self.conn.pipeline(transaction=True)
+        try:
+            pipe.watch(*self._watch_keys())
+            if self._get_version(pipe) != s.version:
+                raise ConflictError(self.room_id)
+            pipe.multi()
+            self._write_changes(pipe)
+            self._incr_version(pipe)
+            pipe.execute()
+        except WatchError:
+            raise ConflictError(self.room_id)
+        finally:
+            pipe.reset()
+        self._committed()
+
+    def _committed(self):
+        s = self.store
+        s.version = s.data[self.key("version")] = _encode(int(s.version or 0) + 1)
+        s.decoded.pop(self.key("version"), None)
+        s.dirty = set()
+        s.expires = {}
+
+    def _watch_keys(self):
+        return [self.key("version")]
+
+    def _get_version(self, pipe):
+        """
+        :return: the current version (an awaitable with an async connection)
+        """
+        return pipe.get(self.key("version"))
+
+    def _incr_version(self, pipe):
+        version = self.key("version")
+        pipe.incr(version)
+        if self.timer:
+            pipe.expire(version, self.timer)
+
+    def _write_changes(self, pipe):
+        s = self.store
+        for key in s.dirty:
+            _write_key(pipe, key, s.data.get(key), self.timer)
+        for key, sec in s.expires.items():
+            pipe.expire(key, sec)
+
+    def _fetch(self, key, type):
+        return _fetch(self.conn, key, type)
+
+    def _read(self, key, type):
+        data = self.store.data
+        if key not in data:
+            # a key out of the room such as a user who is not a player
+            data[key] = self._fetch(key, type)
+        value = data[key]
+        if value is None and type != "string":
+            # deleted
+            return [] if type == "list" else {}
+        return value
+
+    def _write(self, key, value):
+        self.store.data[key] = value
+        self.store.dirty.add(key)
+        self.store.decoded.pop(key, None)
+
+    def expire(self, key, sec):
+        if not isinstance(key, (list, set)):
+            key = [key]
+        for k in key:
+            self.store.expires[self.key(k)] = sec
+
+    def flush(self):
+        super().flush()
+        self.store.data = {}
+        self.store.dirty = set()
+        self.store.expires = {}
+        self.store.decoded = {}
+
+
+# The hash layout keeps the keys of a room as fields of one hash.
+# The user key is shared among rooms and the chat keys are appended too often,
+# so they are kept as they are.
+HASH_KEY = "{room_id}_room"
+HASH_KEYS = [k for k in KEYS if k != "user" and not k.startswith("chat_")]
+SCHEMA_FIELD = "_schema"
+# the key layout is 1
+SCHEMA_VERSION = 2
+
+
+def get_field(key, user_id=None):
+    """
+    :return: the field of a room hash such as 'phase' or 'hand:3'
+    """
+    if key in ["role", "hand"] and user_id is None:
+        raise ValueError("You must take user_id as an argument when key is role or hand.")
+    if key in USER_KEYS:
+        return "%s:%s" % (key, user_id)
+    return key
+
+
+def _is_field(key):
+    return key.split(":")[0] in HASH_KEYS
+
+
+def encode_field(value):
+    """
+    Encode a raw value into a field.
+    A list is comma separated since it has only ids or cards.
+    """
+    if isinstance(value, list):
+        if any(b"," in v for v in value):
+            raise ValueError("A list in a room hash must not contain a comma: %s" % value)
+        return b",".join(value)
+    elif isinstance(value, dict):
+        return json.dumps(decode(value), separators=(",", ":")).encode("utf-8")
+    return value
+
+
+def decode_field(field, value):
+    """
+    Decode a field into a raw value
+    """
+    type = KEYS[field.split(":")[0]][1]
+    if type == "list":
+        return value.split(b",") if value else []
+    elif type == "hash":
+        if not value:
+            return {}
+        return {_encode(k): _encode(v) for k, v in json.loads(value.decode("utf-8")).items()}
+    return value
+
+
+def _check_schema(schema):
+    if schema is not None and int(schema) != SCHEMA_VERSION:
+        raise ValueError("Unknown schema version of a room hash: %s" % schema)
+
+
+def _write_fields(pipe, hash_key, values, timer=None):
+    """
+    :values: {field: raw value} where an empty value removes the field
+    """
+    fields = {}
+    for field, value in values.items():
+        if value is None or value == [] or value == {}:
+            pipe.hdel(hash_key, field)
+        else:
+            fields[field] = encode_field(value)
+    if fields:
+        fields[SCHEMA_FIELD] = SCHEMA_VERSION
+        pipe.hset(hash_key, mapping=fields)
+    if timer:
+        pipe.expire(hash_key, timer)
+
+
+class HashLayout(object):
+    """
+    Mixin for the adaptors of the hash layout
+    """
+
+    @property
+    def hash_key(self):
+        return HASH_KEY.format(room_id=self.room_id)
+
+    def key(self, k):
+        if k in HASH_KEYS:
+            return get_field(k, self.user_id)
+        return super().key(k)
+
+    def _members(self, pipe):
+        # the keys of the users are fields
+        return False
+
+    def _room_keys(self, members):
+        keys = [get_key(k, self.room_id) for k in ROOM_KEYS if k not in HASH_KEYS]
+        return keys + [self.hash_key, MEMBERS_KEY.format(room_id=self.room_id)]
+
+
+class HashAdaptor(HashLayout, StoreAdaptor):
+    """
+    Reads and writes the fields of a room hash directly.
+    Use a snapshot to change a game because a list is rewritten as a whole.
+    """
+
+    def with_user(self, user_id):
+        return HashAdaptor(
+            room_id=self.room_id,
+            user_id=user_id,
+            conn=self.conn,
+            timer=self.timer,
+        )
+
+    def snapshot(self):
+        adaptor = HashSnapshotAdaptor(self.room_id, self.user_id, self.conn, self.timer)
+        adaptor.load()
+        return adaptor
+
+    def _read(self, key, type):
+        if _is_field(key):
+            return decode_field(key, self.conn.hget(self.hash_key, key))
+        return _fetch(self.conn, key, type)
+
+    def _write(self, key, value):
+        pipe = self.conn.pipeline(transaction=True)
+        if _is_field(key):
+            _write_fields(pipe, self.hash_key, {key: value}, self.timer)
+        else:
+            _write_key(pipe, key, value, self.timer)
+        pipe.execute()
+
+    def set_list(self, key, iterable, delete=True, unique=True):
+        if not _is_field(self.key(key)):
+            # the chat keys are appended with LPUSH
+            return RedisAdaptor.set_list(self, key, iterable, delete, unique)
+        super().set_list(key, iterable, delete, unique)
+
+    def incr(self, key, n=1):
+        k = self.key(key)
+        if not _is_field(k):
+            return super().incr(key, n)
+        pipe = self.conn.pipeline(transaction=True)
+        pipe.hincrby(self.hash_key, k, n)
+        pipe.hset(self.hash_key, SCHEMA_FIELD, SCHEMA_VERSION)
+        if self.timer:
+            pipe.expire(self.hash_key, self.timer)
+        return pipe.execute()[0]
+
+    def expire(self, key, sec):
+        if not isinstance(key, (list, set)):
+            key = [key]
+        for k in key:
+            k = self.key(k)
+            self.conn.expire(self.hash_key if _is_field(k) else k, sec)
+
+
+class HashSnapshotAdaptor(HashLayout, SnapshotAdaptor):
+    """
+    Loads a room hash with one HGETALL and the other keys with one pipeline.
+    """
+
+    def _loader(self):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.hgetall(self.hash_key)
+        values = (yield pipe)[0]
+        _check_schema(values.pop(SCHEMA_FIELD.encode("utf-8"), None))
+        data = {}
+        for field, value in values.items():
+            field = field.decode("utf-8")
+            data[field] = decode_field(field, value)
+
+        # the keys out of the hash: the chat and the users of the players
+        keys = [(get_key(k, self.room_id), KEYS[k][1]) for k in ROOM_KEYS if k not in HASH_KEYS]
+        keys += [(get_key("user", self.room_id, uid), "hash") for uid in decode(data.get("player_ids", []))]
+        pipe = self.conn.pipeline(transaction=False)
+        for key, type in keys:
+            _fetch(pipe, key, type)
+        values = yield pipe
+        data.update((key, value) for (key, _), value in zip(keys, values))
+        self._loaded(data)
+
+    def _watch_keys(self):
+        return [self.hash_key]
+
+    def _get_version(self, pipe):
+        return pipe.hget(self.hash_key, self.key("version"))
+
+    def _incr_version(self, pipe):
+        pipe.hincrby(self.hash_key, self.key("version"), 1)
+        if self.timer:
+            pipe.expire(self.hash_key, self.timer)
+
+    def _write_changes(self, pipe):
+        s = self.store
+        fields = {}
+        for key in s.dirty:
+            if _is_field(key):
+                fields[key] = s.data.get(key)
+            else:
+                _write_key(pipe, key, s.data.get(key), self.timer)
+        _write_fields(pipe, self.hash_key, fields, self.timer)
+        for key, sec in s.expires.items():
+            pipe.expire(self.hash_key if _is_field(key) else key, sec)
+
+    def _read(self, key, type):
+        if _is_field(key) and key not in self.store.data:
+            # the whole hash has been loaded
+            self.store.data[key] = None
+        return super()._read(key, type)
+
+
+class InMemory(object):
+    """
+    Mixin which keeps a room in a MemoryStore of this process instead of redis.
+    The rooms are not shared with the other processes.
+    """
+
+    def __init__(self, room_id, user_id=None, conn=None, timer=None, **kwargs):
+        super().__init__(room_id, user_id, conn or memory, timer, **kwargs)
+
+    def _fetch(self, key, type):
+        return self.conn.get(key)
+
+    def register(self):
+        key = MEMBERS_KEY.format(room_id=self.room_id)
+        members = set(self.conn.get(key) or ())
+        members.add(_encode(self.user_id))
+        self.conn.set(key, members)
+        if self.timer:
+            self.conn.expire(key, self.timer)
+        # a room is registered when it is joined, and the abandoned rooms are dropped
+        self.conn.sweep()
+
+    def room_keys(self):
+        members = [self.conn.get(MEMBERS_KEY.format(room_id=self.room_id)) or [],
+                   self.conn.get(get_key("player_ids", self.room_id)) or []]
+        return self._room_keys(members)
+
+
+class MemoryAdaptor(InMemory, DecodeOnce, StoreAdaptor):
+    """
+    Reads and writes a room in memory without a round trip.
+    A value is decoded once until it is written, as a snapshot does.
+    """
+
+    @property
+    def store(self):
+        return self.conn
+
+    def with_user(self, user_id):
+        return self.__class__(
+            room_id=self.room_id,
+            user_id=user_id,
+            conn=self.conn,
+            timer=self.timer,
+        )
+
+    def snapshot(self):
+        adaptor = MemorySnapshotAdaptor(self.room_id, self.user_id, self.conn, self.timer)
+        adaptor.load()
+        return adaptor
+
+    def _read(self, key, type):
+        value = self.conn.get(key)
+        if value is None and type != "string":
+            return [] if type == "list" else {}
+        return value
+
+    def _write(self, key, value):
+        self.conn.set(key, value)
+        if self.timer:
+            self.conn.expire(key, self.timer)
+
+    def expire(self, key, sec):
+        if not isinstance(key, (list, set)):
+            key = [key]
+        for k in key:
+            self.conn.expire(self.key(k), sec)
+
+
+class MemorySnapshotAdaptor(InMemory, SnapshotAdaptor):
+    """
+    Copies a room from a MemoryStore, and commits it back if the version has not changed.
+    The decoded values are copied too, so an unchanged value is not decoded again.
+    """
+
+    def load(self):
+        user_ids = decode(self.conn.get(get_key("player_ids", self.room_id)) or [])
+        keys = [key for key, _ in self._keys(user_ids)]
+        self._loaded({key: self.conn.get(key) for key in keys})
+        self.store.decoded = {key: dict(self.conn.decoded[key]) for key in keys if key in self.conn.decoded}
+
+    def commit(self):
+        s = self.store
+        if not (s.dirty or s.expires):
+            return
+        if self.conn.get(self.key("version")) != s.version:
+            raise ConflictError(self.room_id)
+        for key in s.dirty:
+            value = s.data.get(key)
+            self.conn.set(key, value)
+            if self.timer and value:
+                self.conn.expire(key, self.timer)
+        for key, sec in s.expires.items():
+            self.conn.expire(key, sec)
+        self._committed()
+        version = self.key("version")
+        self.conn.set(version, s.version)
+        if self.timer:
+            self.conn.expire(version, self.timer)
+
     def flush(self):
-        prefix = ("%s_" % self.room_id).encode("utf-8")
-        for k in self.conn.keys("*"):
-            if k.startswith(prefix):
-                self.conn.delete(k)
+        self.conn.unlink(*self.room_keys())
+        self.store.data = {}
+        self.store.dirty = set()
+        self.store.expires = {}
+        self.store.decoded = {}
+
+
+# the layouts selected by settings.REDIS_ROOM_LAYOUT
+LAYOUTS = {
+    "keys": RedisAdaptor,
+    "hash": HashAdaptor,
+    "memory": MemoryAdaptor,
+}
+
+
+def get_adaptor(room_id, user_id=None, conn=None, timer=None):
+    """
+    :return: an adaptor of the layout in the settings
+    """
+    layout = getattr(settings, "REDIS_ROOM_LAYOUT", "keys")
+    return LAYOUTS[layout](room_id, user_id=user_id, conn=conn, timer=timer)
+
+
+def migrate(room_id, conn=None, timer=None):
+    """
+    Move a room from the key layout to the hash layout in one transaction.
+    :timer: seconds to expire the room hash, the TTL of the room by default
+    :return: False if there is nothing to move or the room hash already exists
+    """
+    conn = conn or settings.REDIS_CONNECTION
+    old = SnapshotAdaptor(room_id, conn=conn)
+    new = HashSnapshotAdaptor(room_id, conn=conn, timer=timer)
+    pipe = conn.pipeline(transaction=True)
+    try:
+        pipe.watch(old.key("player_ids"), old.key("version"), new.hash_key)
+        if pipe.exists(new.hash_key):
+            return False
+        old.load()
+        keys = []
+        fields = {}
+        for uid in [None] + old.get_list("player_ids"):
+            for name in ROOM_KEYS if uid is None else USER_KEYS:
+                if name in HASH_KEYS:
+                    key = get_key(name, room_id, uid)
+                    keys.append(key)
+                    fields[get_field(name, uid)] = old.store.data.get(key)
+        if not any(fields.values()):
+            return False
+        if timer is None:
+            # keep the expiration of a room for an anonymous player
+            ttl = pipe.ttl(old.key("player_ids"))
+            timer = ttl if ttl and ttl > 0 else None
+
+        pipe.multi()
+        _write_fields(pipe, new.hash_key, fields, timer)
+        pipe.delete(*keys)
+        pipe.execute()
+    except WatchError:
+        raise ConflictError(room_id)
+    finally:
+        pipe.reset()
+    return True
+
+
+def scan_room_keys(conn, room_id, count=1000):
+    """
+    Find the keys of a room with SCAN for the keys which flush() doesn't know.
+    :return: a list of keys
+    """
+    return list(conn.scan_iter(match="%s_*" % room_id, count=count))
+
+
+def flush_orphans(conn, room_id, count=1000):
+    """
+    Delete the keys of a room which are left by a bug or an old version.
+    :return: the number of deleted keys
+    """
+    keys = scan_room_keys(conn, room_id, count)
+    for i in range(0, len(keys), count):
+        conn.unlink(*keys[i:i + count])
+    return len(keys)
+
+
+def transaction(adaptor, func, retries=3):
+    """
+    Apply func to a snapshot of a room and commit it.
+    If another process commits first, func is applied again to a new snapshot.
+    :func: a function which takes a SnapshotAdaptor
+    :return: what func returns
+    """
+    for _ in range(retries):
+        snapshot = adaptor.snapshot()
+        result = func(snapshot)
+        try:
+            snapshot.commit()
+            return result
+        except ConflictError:
+            logger.info("Retry an action on room %s" % adaptor.room_id)
+    raise ConflictError(adaptor.room_id)
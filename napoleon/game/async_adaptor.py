@@ -0,0 +1,378 @@
+"""
+Adaptors on redis.asyncio for the tornado handlers.
+
+The game logic is synchronous, so a handler loads a snapshot of a room,
+changes it in memory and commits it:
+
+    snapshot = await adaptor.snapshot()
+    phase.take_action(GameState(snapshot), user_id, json)
+    await snapshot.commit()
+
+The other operations have the same names as RedisAdaptor and are coroutines.
+"""
+import logging
+from django.conf import settings
+from redis import WatchError
+
+from napoleon.game.adaptor import (
+    RedisAdaptor, SnapshotAdaptor, HashSnapshotAdaptor, HashLayout, ConflictError,
+    MemoryAdaptor, MemorySnapshotAdaptor,
+    MEMBERS_KEY, SCHEMA_FIELD, SCHEMA_VERSION,
+    decode, decode_field, _is_field, _fetch, _write_key, _write_fields,
+    _encode, _pushed, _removed, _with_item, _without_item,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def _str(value):
+    # redis.asyncio doesn't convert a bool as the blocking client does
+    return str(value) if isinstance(value, bool) else value
+
+
+async def _flush(adaptor):
+    pipe = adaptor.conn.pipeline(transaction=False)
+    members = await pipe.execute() if adaptor._members(pipe) else []
+    await adaptor.conn.unlink(*adaptor._room_keys(members))
+
+
+class AsyncSnapshot(object):
+    """
+    Mixin which loads and commits a snapshot on an async connection
+    """
+
+    async def load(self):
+        steps = self._loader()
+        result = None
+        try:
+            while True:
+                result = await steps.send(result).execute()
+        except StopIteration:
+            pass
+
+    async def commit(self):
+        s = self.store
+        if not (s.dirty or s.expires):
+            return
+        pipe = self.conn.pipeline(transaction=True)
+        try:
+            await pipe.watch(*self._watch_keys())
+            if await self._get_version(pipe) != s.version:
+                raise ConflictError(self.room_id)
+            pipe.multi()
+            self._write_changes(pipe)
+            self._incr_version(pipe)
+            await pipe.execute()
+        except WatchError:
+            raise ConflictError(self.room_id)
+        finally:
+            await pipe.reset()
+        self._committed()
+
+    def _read(self, key, type):
+        data = self.store.data
+        if key not in data:
+            # a key out of the room such as a user of the audience.
+            # it can't be fetched without blocking the loop
+            data[key] = None
+        return super()._read(key, type)
+
+    async def flush(self):
+        await _flush(self)
+        self.store.data = {}
+        self.store.dirty = set()
+        self.store.expires = {}
+        self.store.decoded = {}
+
+
+class AsyncSnapshotAdaptor(AsyncSnapshot, SnapshotAdaptor):
+    pass
+
+
+class AsyncHashSnapshotAdaptor(AsyncSnapshot, HashSnapshotAdaptor):
+    pass
+
+
+class AsyncRedisAdaptor(RedisAdaptor):
+    """
+    The same interface as RedisAdaptor whose operations are coroutines
+    """
+
+    snapshot_class = AsyncSnapshotAdaptor
+
+    def __init__(self, room_id, user_id=None, conn=None, timer=None):
+        super().__init__(room_id, user_id, conn or settings.REDIS_ASYNC_CONNECTION, timer)
+
+    def with_user(self, user_id):
+        return self.__class__(
+            room_id=self.room_id,
+            user_id=user_id,
+            conn=self.conn,
+            timer=self.timer,
+        )
+
+    async def snapshot(self):
+        adaptor = self.snapshot_class(self.room_id, self.user_id, self.conn, self.timer)
+        await adaptor.load()
+        return adaptor
+
+    async def get_list(self, key, type=None):
+        return decode(await self.conn.lrange(self.key(key), 0, -1), type=type)
+
+    async def set_list(self, key, iterable, delete=True, unique=True):
+        key = self.key(key)
+        if not isinstance(iterable, (list, tuple, set)):
+            if unique:
+                # use a list as a unique container
+                args = [_str(iterable), int(delete), self.timer or 0]
+                await self.scripts.push_unique(keys=[key], args=args, client=self.conn)
+                return
+            iterable = [iterable]
+        pipe = self.conn.pipeline(transaction=True)
+        if delete:
+            pipe.delete(key)
+        if iterable:
+            pipe.lpush(key, *[_str(i) for i in iterable])
+        if self.timer:
+            pipe.expire(key, self.timer)
+        await pipe.execute()
+
+    async def rem_list(self, key, value):
+        await self.conn.lrem(self.key(key), 0, _str(value))
+
+    async def get(self, key, type=None):
+        return decode(await self.conn.get(self.key(key)), type=type)
+
+    async def set(self, key, value):
+        await self.conn.set(self.key(key), _str(value))
+        if self.timer:
+            await self.expire(key, self.timer)
+
+    async def get_dict(self, key, type=None):
+        return decode(await self.conn.hgetall(self.key(key)), type=type)
+
+    async def get_dict_item(self, key, k, type=None):
+        return decode(await self.conn.hget(self.key(key), _str(k)), type=type)
+
+    async def set_dict(self, key, k, v):
+        await self.conn.hset(self.key(key), _str(k), _str(v))
+        if self.timer:
+            await self.expire(key, self.timer)
+
+    async def rem_dict(self, key, k):
+        await self.conn.hdel(self.key(key), _str(k))
+
+    async def incr(self, key, n=1):
+        value = await self.conn.incr(self.key(key), n)
+        if self.timer:
+            await self.expire(key, self.timer)
+        return value
+
+    async def delete(self, key):
+        await self.conn.delete(self.key(key))
+
+    async def expire(self, key, sec):
+        if not isinstance(key, (list, set)):
+            key = [key]
+        for k in key:
+            await self.conn.expire(self.key(k), sec)
+
+    async def register(self):
+        key = MEMBERS_KEY.format(room_id=self.room_id)
+        await self.conn.sadd(key, self.user_id)
+        if self.timer:
+            await self.conn.expire(key, self.timer)
+
+    async def flush(self):
+        await _flush(self)
+
+    # the blocking operations of RedisAdaptor would return coroutines which are never awaited
+
+    def batch(self):
+        raise NotImplementedError("Change a room with a snapshot on an async connection")
+
+    def room_keys(self):
+        raise NotImplementedError("The keys of a room are found by flush on an async connection")
+
+
+class AsyncHashAdaptor(HashLayout, AsyncRedisAdaptor):
+    """
+    The same interface as HashAdaptor whose operations are coroutines
+    """
+
+    snapshot_class = AsyncHashSnapshotAdaptor
+
+    async def _read(self, key, type):
+        if _is_field(key):
+            return decode_field(key, await self.conn.hget(self.hash_key, key))
+        return await _fetch(self.conn, key, type)
+
+    async def _write(self, key, value):
+        pipe = self.conn.pipeline(transaction=True)
+        if _is_field(key):
+            _write_fields(pipe, self.hash_key, {key: value}, self.timer)
+        else:
+            _write_key(pipe, key, value, self.timer)
+        await pipe.execute()
+
+    async def get_list(self, key, type=None):
+        return decode(list(await self._read(self.key(key), "list")), type=type)
+
+    async def set_list(self, key, iterable, delete=True, unique=True):
+        k = self.key(key)
+        if not _is_field(k):
+            # the chat keys are appended with LPUSH
+            return await super().set_list(key, iterable, delete, unique)
+        value = _pushed([] if delete else await self._read(k, "list"), iterable, unique)
+        if value is not None:
+            await self._write(k, value)
+
+    async def rem_list(self, key, value):
+        k = self.key(key)
+        await self._write(k, _removed(await self._read(k, "list"), value))
+
+    async def get(self, key, type=None):
+        return decode(await self._read(self.key(key), "string"), type=type)
+
+    async def set(self, key, value):
+        await self._write(self.key(key), _encode(value))
+
+    async def get_dict(self, key, type=None):
+        return decode(dict(await self._read(self.key(key), "hash")), type=type)
+
+    async def get_dict_item(self, key, k, type=None):
+        return decode((await self._read(self.key(key), "hash")).get(_encode(k)), type=type)
+
+    async def set_dict(self, key, k, v):
+        key = self.key(key)
+        await self._write(key, _with_item(await self._read(key, "hash"), k, v))
+
+    async def rem_dict(self, key, k):
+        key = self.key(key)
+        await self._write(key, _without_item(await self._read(key, "hash"), k))
+
+    async def incr(self, key, n=1):
+        k = self.key(key)
+        if not _is_field(k):
+            return await super().incr(key, n)
+        pipe = self.conn.pipeline(transaction=True)
+        pipe.hincrby(self.hash_key, k, n)
+        pipe.hset(self.hash_key, SCHEMA_FIELD, SCHEMA_VERSION)
+        if self.timer:
+            pipe.expire(self.hash_key, self.timer)
+        return (await pipe.execute())[0]
+
+    async def delete(self, key):
+        await self._write(self.key(key), None)
+
+    async def expire(self, key, sec):
+        if not isinstance(key, (list, set)):
+            key = [key]
+        for k in key:
+            k = self.key(k)
+            await self.conn.expire(self.hash_key if _is_field(k) else k, sec)
+
+
+class AsyncMemorySnapshotAdaptor(MemorySnapshotAdaptor):
+    """
+    A MemorySnapshotAdaptor whose load, commit and flush are coroutines
+    """
+
+    async def load(self):
+        super().load()
+
+    async def commit(self):
+        super().commit()
+
+    async def flush(self):
+        super().flush()
+
+
+class AsyncMemoryAdaptor(MemoryAdaptor):
+    """
+    The same interface as MemoryAdaptor whose operations are coroutines.
+    They don't wait for anything, so a handler reads a room without a round trip.
+    """
+
+    async def snapshot(self):
+        adaptor = AsyncMemorySnapshotAdaptor(self.room_id, self.user_id, self.conn, self.timer)
+        await adaptor.load()
+        return adaptor
+
+    async def get_list(self, key, type=None):
+        return super().get_list(key, type)
+
+    async def set_list(self, key, iterable, delete=True, unique=True):
+        super().set_list(key, iterable, delete, unique)
+
+    async def rem_list(self, key, value):
+        super().rem_list(key, value)
+
+    async def get(self, key, type=None):
+        return super().get(key, type)
+
+    async def set(self, key, value):
+        super().set(key, value)
+
+    async def get_dict(self, key, type=None):
+        return super().get_dict(key, type)
+
+    async def get_dict_item(self, key, k, type=None):
+        return super().get_dict_item(key, k, type)
+
+    async def set_dict(self, key, k, v):
+        super().set_dict(key, k, v)
+
+    async def rem_dict(self, key, k):
+        super().rem_dict(key, k)
+
+    async def incr(self, key, n=1):
+        return super().incr(key, n)
+
+    async def delete(self, key):
+        super().delete(key)
+
+    async def expire(self, key, sec):
+        super().expire(key, sec)
+
+    async def register(self):
+        super().register()
+
+    async def flush(self):
+        super().flush()
+
+    # a sync context would yield operations which are never awaited
+    def batch(self):
+        raise NotImplementedError("Change a room with a snapshot on an async connection")
+
+
+# the layouts selected by settings.REDIS_ROOM_LAYOUT
+LAYOUTS = {
+    "keys": AsyncRedisAdaptor,
+    "hash": AsyncHashAdaptor,
+    "memory": AsyncMemoryAdaptor,
+}
+
+
+def get_adaptor(room_id, user_id=None, conn=None, timer=None):
+    """
+    :return: an async adaptor of the layout in the settings
+    """
+    layout = getattr(settings, "REDIS_ROOM_LAYOUT", "keys")
+    return LAYOUTS[layout](room_id, user_id=user_id, conn=conn, timer=timer)
+
+
+async def transaction(adaptor, func, retries=3):
+    """
+    The same as adaptor.transaction on an async adaptor
+    """
+    for _ in range(retries):
+        snapshot = await adaptor.snapshot()
+        result = func(snapshot)
+        try:
+            await snapshot.commit()
+            return result
+        except ConflictError:
+            logger.info("Retry an action on room %s" % adaptor.room_id)
+    raise ConflictError(adaptor.room_id)
@@ -0,0 +1,93 @@
+"""
+Vectorized versions of card.deal, card.decide and card.winner for simulations.
+A card is its value and a board is a row of an integer array.
+"""
+import numpy as np
+
+from napoleon.game import card
+
+
+# SUITS[value] is the suit value of a card, 0 for jokers
+SUITS = np.array([s.value if s else 0 for s in card.SUIT_OF], dtype=np.int8)
+
+# the index of a lead suit in rank arrays is the same as SUITS
+LEAD_SUITS = [None] + list(card.Suit)
+
+
+def deal_many(n_games, number_of_players=5, rng=None):
+    """
+    :rng: numpy.random.Generator
+    :return: (hands, rest)
+             hands has the shape (n_games, number_of_players, cards per player)
+             rest has the shape (n_games, the number of rest)
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    number_of_rest = card.REST[number_of_players]
+    per_player = (card.NUMBER_OF_CARDS - number_of_rest) // number_of_players
+    decks = rng.random((n_games, card.NUMBER_OF_CARDS)).argsort(axis=1).astype(np.int8) + 1
+    rest = decks[:, :number_of_rest]
+    hands = decks[:, number_of_rest:number_of_rest + per_player * number_of_players]
+    return hands.reshape(n_games, number_of_players, per_player), rest
+
+
+_tables = {}
+
+
+def _rank_tables(trump_suit, is_first_round=False, rule=None):
+    """
+    :return: (ranks, suited_ranks, yoromeki)
+             ranks and suited_ranks have the shape (5, 55) indexed by lead suit and card value
+    """
+    rule_key = None if rule is None else tuple(sorted(rule.items()))
+    key = (trump_suit, bool(is_first_round), rule_key)
+    if key not in _tables:
+        tables = [card.rank_table(trump_suit, s, is_first_round, rule) for s in LEAD_SUITS]
+        _tables[key] = (
+            np.array([t.ranks for t in tables], dtype=np.int16),
+            np.array([t.suited_ranks for t in tables], dtype=np.int16),
+            tables[0].yoromeki,
+        )
+    return _tables[key]
+
+
+def ranks(boards, leads, trump_suit, is_first_round=False, rule=None):
+    """
+    :boards: an integer array of the shape (n_boards, n_cards)
+    :leads: an integer array of the column index of the lead card for each board
+    :return: an integer array of the same shape as boards. The strongest card has the highest rank.
+    """
+    boards = np.asarray(boards)
+    rows = np.arange(len(boards))
+    rank, suited_rank, yoromeki = _rank_tables(trump_suit, is_first_round, rule)
+
+    lead_suits = SUITS[boards[rows, leads]][:, None]
+    suited = (SUITS[boards] == lead_suits).all(axis=1)[:, None]
+    r = np.where(suited, suited_rank[lead_suits, boards], rank[lead_suits, boards])
+
+    if yoromeki:
+        queens = boards == card._QUEEN
+        both = (boards == card._ALMIGHTY).any(axis=1) & queens.any(axis=1)
+        r[both[:, None] & queens] = r.max() + 1
+    return r
+
+
+def decide(boards, trump_suit, is_first_round=False, rule=None):
+    """
+    :boards: an integer array of the shape (n_boards, n_cards) whose last column is the lead
+    :return: an integer array of the values of the strongest cards
+    """
+    boards = np.asarray(boards)
+    leads = np.full(len(boards), boards.shape[1] - 1)
+    index = ranks(boards, leads, trump_suit, is_first_round, rule).argmax(axis=1)
+    return boards[np.arange(len(boards)), index]
+
+
+def winner(boards, leads, trump_suit, is_first_round=False, rule=None):
+    """
+    :boards: an integer array of the shape (n_boards, number_of_players)
+             boards[i, j] is the card the player j gives on the board i
+    :leads: an integer array of the players who give the lead cards
+    :return: an integer array of the players who win
+    """
+    return ranks(boards, leads, trump_suit, is_first_round, rule).argmax(axis=1)
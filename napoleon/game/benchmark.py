@@ -0,0 +1,351 @@
+"""
+Benchmarks of the card engine and a room on redis or in memory.
+
+    python manage.py benchmark
+    python manage.py benchmark --save baseline.json
+    python manage.py benchmark --compare baseline.json
+
+Each case prints the round trips to redis and the CPU time of its fastest call.
+A report compared with a baseline (benchmark.json by default) marks the cases
+which take more round trips, or whose CPU time grows over the tolerance.
+The CPU time of a case without round trips is also divided by the time of
+a fixed workload of plain python run between its calls. The ratio doesn't
+depend on a machine, so the baseline is committed. The time of the other
+cases depends on the redis server and is only reported.
+"""
+import json
+import os
+import random
+import sys
+import time
+
+from django.conf import settings
+
+from napoleon.game import card
+from napoleon.game import phase
+from napoleon.game.adaptor import RedisAdaptor, MemoryAdaptor, MemoryStore, transaction
+from napoleon.game.engine import GameEngine
+from napoleon.game.metrics import Instrumented, recording
+from napoleon.game.session import Session, public_json, get_user_id, to_json
+from napoleon.game.state import GameState
+
+
+ROOM_ID = "benchmark"
+
+# the round trips and the ratios of the cases, which are updated with --save when a case changes
+BASELINE = os.path.join(os.path.dirname(__file__), "benchmark.json")
+
+# the ratio of CPU time over a baseline which is a regression
+TOLERANCE = 0.5
+
+# the number of inputs which a case of card functions goes through per call
+INPUTS = 100
+
+
+def reference():
+    """
+    A fixed workload of plain python which the CPU time of a case is divided by
+    """
+    rng = random.Random(0)
+    sorted(rng.random() for _ in range(INPUTS * 100))
+
+
+def _cpu_time(func):
+    start = time.process_time()
+    func()
+    return time.process_time() - start
+
+
+def measure(func, number):
+    """
+    :func: a function which uses an instrumented connection
+    :return: round trips of one call, CPU time (ms) of the fastest call
+             and the ratio to the reference, or None if the call has round trips
+    """
+    with recording() as record:
+        func()
+    if record.round_trips:
+        return record.round_trips, min(_cpu_time(func) for _ in range(number)) * 1000, None
+    # the calls alternate with the reference so that both run on the same state of the machine,
+    # and the fastest ones are the least disturbed by the other processes
+    times, references = zip(*[(_cpu_time(func), _cpu_time(reference)) for _ in range(number)])
+    return 0, min(times) * 1000, min(times) / min(references)
+
+
+def cards(number=50):
+    """
+    :return: [(name, round trips, ms, ratio)] of the card functions
+    """
+    rng = random.Random(0)
+    random.seed(0)
+    deals = [card.deal(5) for _ in range(INPUTS)]
+    # a board of the first cards of the players, whose lead is the last
+    boards = [[h[0] for h in hands] for hands, _ in deals]
+    player_cards = [{str(i): c for i, c in enumerate(b)} for b in boards]
+    trumps = [rng.choice(list(card.Suit)) for _ in deals]
+    hands = [card.CardSet(hands[0][1:]) for hands, _ in deals]
+    ints = [[int(c) for c in hands[0]] for hands, _ in deals]
+
+    def deal():
+        for _ in range(INPUTS):
+            card.deal(5)
+
+    def decide():
+        for b, t in zip(boards, trumps):
+            card.decide(b, t)
+
+    def winner():
+        for b, p, t in zip(boards, player_cards, trumps):
+            card.winner(b, p, t)
+
+    def possible_cards():
+        for b, h, t in zip(boards, hands, trumps):
+            card.possible_cards(b[-2:], h, t)
+
+    def from_list():
+        for i in ints:
+            card.from_list(i)
+
+    return [
+        ("card.%s x%d" % (func.__name__, INPUTS),) + measure(func, number)
+        for func in [deal, decide, winner, possible_cards, from_list]
+    ]
+
+
+def play(take_action, get_state, user_ids, seed=0):
+    """
+    Play a game by the phase actions. The first player is napoleon
+    and the cards are chosen at random by seed.
+    :take_action: a function which takes user_id and json
+    :get_state: a function which returns a GameState to read the room
+    """
+    rng = random.Random(seed)
+    random.seed(seed)
+
+    def act(user_id, json):
+        if not take_action(user_id, json):
+            raise ValueError("%s is rejected in the benchmark" % json)
+
+    act(user_ids[0], {"action": "start"})
+    act(user_ids[0], {"action": "declare", "declaration": int(card.Declaration(13, card.Suit.spade))})
+    for user_id in user_ids[1:]:
+        act(user_id, {"action": "pass"})
+    act(user_ids[0], {"action": "adjutant", "adjutant": int(card.ALMIGHTY)})
+    state = get_state()
+    unused = sorted(int(c) for c in state.create_player(user_ids[0]).hand)[:len(state.rest)]
+    act(user_ids[0], {"action": "discard", "unused": unused})
+    while True:
+        state = get_state()
+        if state.phase.current == "finished":
+            return
+        turn = state.turn
+        act(turn.user_id, {"action": "select", "selected": int(rng.choice(sorted(turn.possible_cards, key=int)))})
+
+
+def game(number=50):
+    """
+    :return: [(name, round trips, ms, ratio)] of a game in memory
+    """
+    user_ids = [str(i + 1) for i in range(5)]
+
+    def engine():
+        e = GameEngine(user_ids)
+        play(e.take_action, lambda: e, user_ids)
+
+    return [("game in GameEngine",) + measure(engine, number)]
+
+
+def setup(conn, players=5):
+    """
+    :return: an adaptor of a room where players are choosing an adjutant
+    """
+    adaptor = join(conn, players)
+    user_ids = [str(i + 1) for i in range(players)]
+    phase.take_action(GameState(adaptor), user_ids[0], {"action": "start"})
+    phase.take_action(GameState(adaptor), user_ids[0], {"action": "declare", "declaration": 60})
+    for user_id in user_ids[1:]:
+        phase.take_action(GameState(adaptor), user_id, {"action": "pass"})
+    return adaptor
+
+
+def join(conn, players=5, layout=RedisAdaptor):
+    """
+    :layout: the class of the adaptor
+    :return: an adaptor of a new room where players have joined
+    """
+    from napoleon.room.state import User
+    adaptor = layout(ROOM_ID, conn=conn)
+    adaptor.flush()
+    for i in range(players):
+        User(str(i + 1), "session%d" % (i + 1), adaptor).join()
+    return adaptor
+
+
+def play_transactions(adaptor, players=5):
+    """
+    Play a game in a room where players have joined as the handlers play it
+    """
+    def take_action(user_id, json):
+        return transaction(adaptor, lambda a: phase.take_action(GameState(a), user_id, json))
+
+    play(take_action, lambda: GameState(adaptor.snapshot()), [str(i + 1) for i in range(players)])
+
+
+def redis_game(conn, number=5):
+    """
+    :return: [(name, round trips, ms, ratio)] of a game on redis as the handlers play it
+    """
+    conn = Instrumented(conn)
+    results = [("game on redis",) + measure(lambda: play_transactions(join(conn)), number)]
+    RedisAdaptor(ROOM_ID, conn=conn).flush()
+    return results
+
+
+def memory_game(number=5):
+    """
+    :return: [(name, round trips, ms, ratio)] of the same game in MemoryAdaptor
+    """
+    store = MemoryStore()
+    return [("game in MemoryAdaptor",) + measure(lambda: play_transactions(join(store, layout=MemoryAdaptor)), number)]
+
+
+def _reflect(obj, skip=()):
+    return to_json({key: getattr(obj, key) for key in dir(obj) if key not in skip})
+
+
+def reflected_json(adaptor, user_id):
+    """
+    The JSON of a state built as session.py did before the schemas,
+    which read every attribute that dir() lists and then hid the private ones.
+    It is the baseline of the cases of state.to_json.
+    """
+    state = GameState(adaptor)
+
+    def player_json(player):
+        json = _reflect(player, skip={"state"})
+        json["is_valid"] = player.user_id == user_id
+        if not json["is_valid"]:
+            json["hand"] = json["possible_cards"] = []
+        return json
+
+    json = _reflect(state, skip={"players", "phase"})
+    json["players"] = [player_json(p) for p in state.players]
+    json["phase"] = _reflect(state.phase, skip={"state"})
+    if state.napoleon != user_id:
+        json["rest"] = json["unused"] = []
+    return json
+
+
+def serialization(conn, number=50):
+    """
+    :return: [(name, round trips, ms, ratio)]
+    """
+    conn = Instrumented(conn)
+    adaptor = setup(conn)
+    session_ids = ["session%d" % i for i in range(1, 6)]
+
+    def live():
+        # every property is read from redis as the handlers used to do
+        return Session(adaptor, session_id=session_ids[0]).state.to_json()
+
+    def snapshot():
+        return Session(adaptor.snapshot(), session_id=session_ids[0]).state.to_json()
+
+    def reflected_live():
+        return reflected_json(adaptor, get_user_id(adaptor, session_ids[0]))
+
+    def reflected_snapshot():
+        snapshot = adaptor.snapshot()
+        return reflected_json(snapshot, get_user_id(snapshot, session_ids[0]))
+
+    def broadcast():
+        snapshot = adaptor.snapshot()
+        public = public_json(snapshot)
+        return [Session(snapshot, session_id=s).to_json(public) for s in session_ids]
+
+    results = []
+    for name, func, n in [
+        ("dir() to_json live", reflected_live, max(number // 10, 1)),
+        ("state.to_json live", live, max(number // 10, 1)),
+        ("dir() to_json snapshot", reflected_snapshot, number),
+        ("state.to_json snapshot", snapshot, number),
+        ("broadcast %d viewers" % len(session_ids), broadcast, number),
+    ]:
+        results.append((name,) + measure(func, n))
+    adaptor.flush()
+    return results
+
+
+def run(conn=None, number=50, redis=True):
+    """
+    :redis: False to run only the cases in memory
+    :return: [(name, round trips, ms, ratio)]
+    """
+    results = cards(number) + game(max(number // 5, 1)) + memory_game(max(number // 10, 1))
+    if redis:
+        conn = conn or settings.REDIS_CONNECTION
+        results += redis_game(conn, max(number // 10, 1)) + serialization(conn, number)
+    return results
+
+
+def save(results, path):
+    baseline = {}
+    for name, round_trips, _, ratio in results:
+        baseline[name] = {"round_trips": round_trips}
+        if ratio is not None:
+            baseline[name]["ratio"] = round(ratio, 4)
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def load(path):
+    """
+    :return: {name: {"round_trips", "ratio"}}
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    A case regresses if it takes more round trips than the baseline,
+    or its ratio of CPU time is more than (1 + tolerance) times the baseline.
+    :return: [(name, round trips, ms, ratio or None, the baseline or None, is_regression)]
+    """
+    report = []
+    for name, round_trips, ms, ratio in results:
+        base = baseline.get(name)
+        is_regression = bool(base) and (
+            round_trips > base["round_trips"]
+            or (ratio is not None and "ratio" in base and ratio > base["ratio"] * (1 + tolerance))
+        )
+        report.append((name, round_trips, ms, ratio, base, is_regression))
+    return report
+
+
+def main(conn=None, number=50, redis=True, save_to=None, baseline=BASELINE, tolerance=TOLERANCE, stdout=sys.stdout):
+    """
+    :baseline: a path of the results saved before
+    :stdout: a stream which the report is written to
+    :return: the names of the cases which regress
+    """
+    results = run(conn, number, redis)
+    base = load(baseline) if baseline else {}
+    regressions = []
+    for name, round_trips, ms, ratio, b, is_regression in compare(results, base, tolerance):
+        line = "%-24s %5d round trips %10.4f ms" % (name, round_trips, ms)
+        if ratio is not None:
+            line += " x%.3f" % ratio
+        if b:
+            line += " (%d" % b["round_trips"]
+            if ratio is not None and "ratio" in b:
+                line += ", %+.1f%% of x%.3f" % ((ratio / b["ratio"] - 1) * 100, b["ratio"])
+            line += ")"
+        if is_regression:
+            line += " REGRESSION"
+            regressions.append(name)
+        stdout.write(line + "\n")
+    if save_to:
+        save(results, save_to)
+    return regressions
@@ -0,0 +1,150 @@
+"""
+Fan-out of websocket messages over redis pub/sub.
+
+A process subscribes to the channel of a path while it has a connection
+on the path. A message published on the channel is given to the callback
+of every subscribing process, including the one which published it,
+so that each process writes to its own connections.
+The messages of a channel are given in order, and a slow callback
+doesn't delay the other channels:
+
+    yield broadcast.subscribe(path, callback)
+    yield broadcast.publish(path, {"version": 3})
+    yield broadcast.notify(path)
+
+With settings.REDIS_ROOM_LAYOUT = "memory" the rooms are not shared
+with the other processes, so a message is given to the callbacks
+of this process without redis.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+import tornado.escape
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "broadcast:{path}"
+
+
+class Broadcast(object):
+    """
+    :conn: an async redis connection. settings.REDIS_ASYNC_CONNECTION by default
+    """
+
+    def __init__(self, conn=None):
+        self._conn = conn
+        self.callbacks = {}
+        self.pubsub = None
+        self.reader = None
+        self.notifying = {}
+        # {channel: the task which gives the last message to the callback}
+        self.dispatching = {}
+
+    @property
+    def conn(self):
+        return self._conn or settings.REDIS_ASYNC_CONNECTION
+
+    @property
+    def is_local(self):
+        return getattr(settings, "REDIS_ROOM_LAYOUT", "keys") == "memory"
+
+    def channel(self, path):
+        return CHANNEL.format(path=path)
+
+    async def subscribe(self, path, callback):
+        """
+        :callback: a coroutine function which takes a path and a message.
+                   The messages are given in the published order.
+        """
+        channel = self.channel(path)
+        self.callbacks[channel] = (path, callback)
+        if self.is_local:
+            return
+        if self.pubsub is None:
+            # a pubsub holds a connection of the pool while subscribing
+            self.pubsub = self.conn.pubsub()
+        await self.pubsub.subscribe(channel)
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.ensure_future(self._read())
+
+    async def unsubscribe(self, path):
+        channel = self.channel(path)
+        if self.callbacks.pop(channel, None) and self.pubsub:
+            await self.pubsub.unsubscribe(channel)
+
+    async def is_watched(self, path):
+        """
+        :return: True if any process has connections on path
+        """
+        channel = self.channel(path)
+        if self.is_local:
+            return channel in self.callbacks
+        (_, number), = await self.conn.pubsub_numsub(channel)
+        return number > 0
+
+    async def publish(self, path, message=None):
+        data = tornado.escape.json_encode(message)
+        if self.is_local:
+            await self._schedule(self.channel(path), data)
+        else:
+            await self.conn.publish(self.channel(path), data)
+
+    def notify(self, path):
+        """
+        Publish None on path as a change of the room.
+        The notifications of a path in one iteration of the loop are merged.
+        :return: a future which is done after publishing
+        """
+        if path not in self.notifying:
+            self.notifying[path] = asyncio.ensure_future(self._notify(path))
+        return self.notifying[path]
+
+    async def _notify(self, path):
+        # the other coroutines in this iteration notify the same future
+        await asyncio.sleep(0)
+        del self.notifying[path]
+        await self.publish(path)
+
+    async def _read(self):
+        # stops when all the channels are unsubscribed
+        async for m in self.pubsub.listen():
+            if m["type"] != "message":
+                continue
+            self._schedule(tornado.escape.native_str(m["channel"]), m["data"])
+
+    def _schedule(self, channel, data):
+        """
+        Give a message to the callback after the previous message of the channel.
+        The reader doesn't wait for it, so that a slow room doesn't stall the others.
+        :return: a task which is done after the callback
+        """
+        previous = self.dispatching.get(channel)
+        task = asyncio.ensure_future(self._dispatch_after(previous, channel, data))
+        self.dispatching[channel] = task
+
+        def done(task):
+            if self.dispatching.get(channel) is task:
+                del self.dispatching[channel]
+        task.add_done_callback(done)
+        return task
+
+    async def _dispatch_after(self, previous, channel, data):
+        if previous is not None:
+            # it doesn't raise even if it is cancelled
+            await asyncio.wait([previous])
+        await self._dispatch(channel, data)
+
+    async def _dispatch(self, channel, data):
+        if channel not in self.callbacks:
+            return
+        path, callback = self.callbacks[channel]
+        try:
+            await callback(path, tornado.escape.json_decode(data))
+        except Exception:
+            # a broken room must not stop the others
+            logger.exception("Failed to broadcast on %s" % channel)
+
+
+broadcast = Broadcast()
@@ -3,17 +3,13 @@ import random
 
 
 def from_int(i):
-    for j in Joker:
-        if j.value == i:
-            return j
+    if 0 < i <= NUMBER_OF_CARDS:
+        return CARDS[i]
     return Plain.from_int(i)
 
 
 def from_list(ints):
-    ls = []
-    for i in ints:
-        ls.append(from_int(i))
-    return ls
+    return [from_int(i) for i in ints]
 
 
 class Suit(enum.Enum):
@@ -66,6 +62,8 @@ class Suit(enum.Enum):
 
 class Mixin(object):
 
+    __slots__ = ()
+
     def order_by_suit(self):
         try:
             return (self.suit.value - 1) * 13 + self.pip
@@ -73,7 +71,18 @@ class Mixin(object):
             return 100
 
     def __eq__(self, other):
-        return int(self) == int(other)
+        if self is other:
+            return True
+        if type(self) is type(other):
+            # cards are interned, so the same card is always the same object
+            return False
+        try:
+            return int(self) == int(other)
+        except (TypeError, ValueError):
+            return NotImplemented
+
+    def __hash__(self):
+        return int(self)
 
     def __lt__(self, other):
         return int(self) <= int(other)
@@ -83,14 +92,36 @@ class Mixin(object):
     __repr__ = lambda self: self.__str__()
 
 
+_interned = {}
+
+
 class Plain(Mixin):
+    """
+    An immutable card. Cards of the same class, pip and suit are interned,
+    so ``Plain(1, Suit.spade) is Plain(1, Suit.spade)``.
+    """
+
+    __slots__ = ("pip", "suit", "value")
+
+    def __new__(cls, pip, suit):
+        key = (cls, pip, suit)
+        self = _interned.get(key)
+        if self is None:
+            self = object.__new__(cls)
+            object.__setattr__(self, "pip", pip)
+            object.__setattr__(self, "suit", suit)
+            object.__setattr__(self, "value", suit.value + (pip - 1) * 4)
+            _interned[key] = self
+        return self
 
-    def __init__(self, pip, suit):
-        self.pip = pip
-        self.suit = suit
+    def __setattr__(self, name, value):
+        raise AttributeError("A card is immutable")
+
+    def __reduce__(self):
+        return (self.__class__, (self.pip, self.suit))
 
     def __int__(self):
-        return self.suit.value + (self.pip - 1) * 4
+        return self.value
 
     def to_json(self):
         return {
@@ -166,6 +197,9 @@ QUEEN = Plain(12, Suit.heart)
 CLUB10 = Plain(10, Suit.club)
 CLUB3 = Plain(3, Suit.club)
 
+_ALMIGHTY = int(ALMIGHTY)
+_QUEEN = int(QUEEN)
+
 
 deck = [
     Plain(p, s)
@@ -176,6 +210,10 @@ deck = [
 NUMBER_OF_CARDS = len(deck)  # 54
 NUMBER_OF_FACE_CARDS = len([c for c in deck if c.is_faced])  # 20
 
+# CARDS[i] is the card whose value is i
+CARDS = (None,) + tuple(sorted(deck, key=int))
+SUIT_OF = tuple(c and c.suit for c in CARDS)
+
 REST = {
     3: 6,
     4: 6,
@@ -187,6 +225,100 @@ REST = {
 RANGE_OF_PLAYERS = REST.keys()
 
 
+class CardSet(object):
+    """
+    A set of cards packed into a 54-bit integer.
+    The card whose value is ``i`` is stored at the bit ``i - 1``.
+    """
+
+    __slots__ = ("mask",)
+
+    def __init__(self, cards=(), mask=0):
+        for c in cards:
+            mask |= 1 << (int(c) - 1)
+        self.mask = mask
+
+    @classmethod
+    def from_mask(cls, mask):
+        return cls(mask=mask)
+
+    def __contains__(self, c):
+        try:
+            i = int(c)
+        except TypeError:
+            return False
+        return 0 < i <= NUMBER_OF_CARDS and bool(self.mask >> (i - 1) & 1)
+
+    def __iter__(self):
+        mask = self.mask
+        while mask:
+            low = mask & -mask
+            yield from_int(low.bit_length())
+            mask ^= low
+
+    def __len__(self):
+        return bin(self.mask).count("1")
+
+    def __bool__(self):
+        return self.mask != 0
+
+    def __eq__(self, other):
+        if isinstance(other, CardSet):
+            return self.mask == other.mask
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, CardSet):
+            return self.mask != other.mask
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.mask)
+
+    def __or__(self, other):
+        return CardSet(mask=self.mask | other.mask)
+
+    def __and__(self, other):
+        return CardSet(mask=self.mask & other.mask)
+
+    def __sub__(self, other):
+        return CardSet(mask=self.mask & ~other.mask)
+
+    def __repr__(self):
+        return "CardSet(%s)" % list(self)
+
+    def of_suit(self, suit):
+        """
+        :return: cards of the suit. Jokers are returned if suit is None.
+        """
+        return CardSet(mask=self.mask & SUIT_MASKS[suit])
+
+    @property
+    def faces(self):
+        return CardSet(mask=self.mask & FACE_MASK)
+
+    @property
+    def number_of_faces(self):
+        return bin(self.mask & FACE_MASK).count("1")
+
+    def highest(self):
+        """
+        :return: the card which has the largest value
+        """
+        if self.mask:
+            return from_int(self.mask.bit_length())
+
+    def to_list(self):
+        return list(self)
+
+    def to_json(self):
+        return [c.to_json() for c in self]
+
+
+SUIT_MASKS = {s: CardSet([c for c in deck if c.suit == s]).mask for s in list(Suit) + [None]}
+FACE_MASK = CardSet([c for c in deck if c.is_faced]).mask
+
+
 def deal(number_of_players=5):
     """
     :return: (hands, rest)
@@ -202,6 +334,8 @@ def deal(number_of_players=5):
 
 class Declaration(Plain):
 
+    __slots__ = ()
+
     @property
     def over(self):
         return [d for d in declarations if d > self]
@@ -213,17 +347,30 @@ declarations = [
 ]
 
 
-def decide(cards, trump_suit, is_first_round=False, rule=None):
+def _strongest(cards, suit):
+    ace = Plain(1, suit)
+    return ace if ace in cards else cards.highest()
+
+
+def decide(cards, trump_suit, is_first_round=False, rule=None, lead=None):
+    """
+    :cards: a board whose last card is the lead, or a CardSet with the lead given
+    :return: the strongest card
+    """
     if len(cards) <= 0:
-        raise
+        raise ValueError("No cards on the board")
+
+    if lead is None:
+        lead = cards[-1]
+    if not isinstance(cards, CardSet):
+        cards = CardSet(cards)
 
     if ALMIGHTY in cards:
-        if QUEEN in cards:
+        if QUEEN in cards and _enabled(rule, "yoromeki"):
             return QUEEN
         else:
             return ALMIGHTY
 
-    lead = cards[-1]
     if Joker.black in cards and Joker.red in cards:
         if trump_suit.is_black:
             return Joker.black
@@ -243,55 +390,153 @@ def decide(cards, trump_suit, is_first_round=False, rule=None):
         return cjack
 
     # same two
-    if not is_first_round:
+    if not is_first_round and _enabled(rule, "same_two"):
         two = Plain(2, lead.suit)
-        if two in cards and all([c.suit == lead.suit for c in cards]):
+        if two in cards and cards.of_suit(lead.suit) == cards:
             return two
 
-    trumps = [c for c in cards if c.suit == trump_suit]
+    trumps = cards.of_suit(trump_suit)
     if trumps:
-        ace = Plain(1, trump_suit)
-        return ace if ace in trumps else max(trumps)
+        return _strongest(trumps, trump_suit)
 
-    cards = [c for c in cards if c.suit == lead.suit]
-    ace = Plain(1, lead.suit)
-    return ace if ace in cards else max(cards)
+    return _strongest(cards.of_suit(lead.suit), lead.suit)
 
 
-def winner(board, player_cards, trump_suit, is_first_round=False, rule=None):
+def winner(board, player_cards, trump_suit, is_first_round=False, rule=None, lead=None):
     """
     Decide which player wins at one round.
     :return: user id
     """
-    if sorted(board) != sorted(player_cards.values()):
+    if len(board) != len(player_cards) or CardSet(board) != CardSet(player_cards.values()):
         raise ValueError("The cards on a board is not the same as the player's cards")
-    strongest = decide(board, trump_suit, is_first_round, rule)
-    return {int(v): k for k, v in player_cards.items()}[int(strongest)]
+    if lead is None:
+        values = [int(c) for c in board]
+    else:
+        values = [int(c) for c in board if c != lead] + [int(lead)]
+    strongest = resolve(values, trump_suit, is_first_round, rule)
+    return {int(v): k for k, v in player_cards.items()}[strongest]
+
+
+def _enabled(rule, name):
+    return rule is None or rule.get(name, True)
+
+
+class RankTable(object):
+    """
+    Ranks of all the cards for a trump suit, a lead suit and a round type.
+    The strongest card on a board is the one with the highest rank,
+    except for yoromeki and same two which depend on the other cards.
+    """
+
+    __slots__ = ("ranks", "suited_ranks", "lead_mask", "yoromeki")
+
+    def __init__(self, trump_suit, lead_suit, is_first_round=False, rule=None):
+        def order(c):
+            return 14 if c.pip == 1 else c.pip
+
+        ranks = [0] * (NUMBER_OF_CARDS + 1)
+        for c in deck:
+            if c.suit == trump_suit:
+                ranks[int(c)] = 200 + order(c)
+            elif lead_suit and c.suit == lead_suit:
+                ranks[int(c)] = 100 + order(c)
+        ranks[int(trump_suit.counter_jack)] = 700
+        ranks[int(trump_suit.right_jack)] = 800
+        strong, weak = (Joker.black, Joker.red) if trump_suit.is_black else (Joker.red, Joker.black)
+        ranks[int(weak)] = 900
+        ranks[int(strong)] = 901
+        ranks[int(ALMIGHTY)] = 1000
+        self.ranks = tuple(ranks)
+
+        # a board whose cards are all of the lead suit
+        self.suited_ranks = self.ranks
+        if lead_suit and not is_first_round and _enabled(rule, "same_two"):
+            two = int(Plain(2, lead_suit))
+            ranks[two] = max(ranks[two], 600)
+            self.suited_ranks = tuple(ranks)
+
+        self.lead_mask = SUIT_MASKS[lead_suit]
+        self.yoromeki = _enabled(rule, "yoromeki")
+
+    def resolve(self, values):
+        """
+        :values: card values on a board whose last one is the lead
+        :return: the value of the strongest card
+        """
+        ranks = self.ranks
+        if self.suited_ranks is not ranks:
+            mask = 0
+            for v in values:
+                mask |= 1 << (v - 1)
+            if not mask & ~self.lead_mask:
+                ranks = self.suited_ranks
+
+        strongest = max(values, key=ranks.__getitem__)
+        if strongest == _ALMIGHTY and self.yoromeki and _QUEEN in values:
+            return _QUEEN
+        return strongest
+
+
+_rank_tables = {}
+
+
+def rank_table(trump_suit, lead_suit, is_first_round=False, rule=None):
+    """
+    :return: a RankTable built once per trump suit, lead suit, round type and rule
+    """
+    rule_key = None if rule is None else (_enabled(rule, "same_two"), _enabled(rule, "yoromeki"))
+    key = (trump_suit, lead_suit, bool(is_first_round), rule_key)
+    table = _rank_tables.get(key)
+    if table is None:
+        table = _rank_tables[key] = RankTable(trump_suit, lead_suit, is_first_round, rule)
+    return table
+
+
+def resolve(values, trump_suit, is_first_round=False, rule=None):
+    """
+    The same as decide, but looks up a rank table.
+    :values: card values on a board whose last one is the lead
+    :return: the value of the strongest card
+    """
+    return rank_table(trump_suit, SUIT_OF[values[-1]], is_first_round, rule).resolve(values)
+
+
+def resolve_many(boards, trump_suit, is_first_round=False, rule=None):
+    """
+    Resolve many tricks at once.
+    :boards: an iterable of card values whose last one is the lead
+    :return: a list of the values of the strongest cards
+    """
+    tables = {s: rank_table(trump_suit, s, is_first_round, rule) for s in SUIT_MASKS}
+    return [tables[SUIT_OF[b[-1]]].resolve(b) for b in boards]
 
 
 def possible_cards(board, hand, trump_suit):
     """
-    :return: a list of cards which a player can give
+    :hand: a list of cards or a CardSet
+    :return: cards which a player can give, in the same type as hand
     """
     if not board:
         return hand
 
+    cards = hand if isinstance(hand, CardSet) else CardSet(hand)
     lead = board[-1]
-    jokers = [j for j in Joker if j in hand]
+    jokers = cards.of_suit(None)
     if lead == CLUB3 and jokers:
-        return jokers
+        possible = jokers
+    else:
+        possible = cards.of_suit(lead.suit)
+        if not possible:
+            return hand
+        possible |= CardSet(mask=cards.mask & ALWAYS_MASKS[trump_suit])
 
-    cs = []
-    for h in hand:
-        if h.suit == lead.suit:
-            cs.append(h)
-    if not cs:
-        return hand
-    for c in always_cards(trump_suit):
-        if c in hand:
-            cs.append(c)
-    return cs
+    if hand is cards:
+        return possible
+    return [h for h in hand if h in possible]
 
 
 def always_cards(trump_suit):
     return list(Joker) + [trump_suit.counter_jack]
+
+
+ALWAYS_MASKS = {s: CardSet(always_cards(s)).mask for s in Suit}
@@ -0,0 +1,59 @@
+"""
+Differences between two JSON states.
+
+A patch is a list of operations:
+    [path, value]: set value at path
+    [path]: delete the key at path
+where path is a list of keys and list indexes from the root.
+static/js/game.js applies a patch in the same way as patch() does.
+"""
+
+
+def diff(old, new, path=()):
+    """
+    :return: a patch which makes old into new
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for k, v in new.items():
+            if k in old:
+                ops += diff(old[k], v, path + (k,))
+            else:
+                ops.append([list(path + (k,)), v])
+        for k in old:
+            if k not in new:
+                ops.append([list(path + (k,))])
+        return ops
+
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        ops = []
+        for i, (o, n) in enumerate(zip(old, new)):
+            ops += diff(o, n, path + (i,))
+        return ops
+
+    # True == 1 but it must be sent as a bool
+    if type(old) is type(new) and old == new:
+        return []
+    return [[list(path), new]]
+
+
+def patch(state, ops):
+    """
+    :return: a new state after applying ops
+    """
+    root = {"state": state}
+    for op in ops:
+        path = ["state"] + op[0]
+        parent = root
+        for k in path[:-1]:
+            parent[k] = _copy(parent[k])
+            parent = parent[k]
+        if len(op) == 1:
+            del parent[path[-1]]
+        else:
+            parent[path[-1]] = op[1]
+    return root["state"]
+
+
+def _copy(value):
+    return dict(value) if isinstance(value, dict) else list(value)
@@ -0,0 +1,281 @@
+"""
+An in-memory game engine.
+
+GameEngine runs the same rules as GameState (and the actions in phase.py)
+because it only replaces how the state is stored. It doesn't need redis,
+so it is used for AI simulations and rule regression.
+"""
+from napoleon.game import card
+from napoleon.game import phase
+from napoleon.game.state import Player, Phase, GameState
+
+
+class EnginePlayer(Player):
+
+    __slots__ = ("is_AI", "user", "_AI", "_hand", "_face", "_role")
+
+    def __init__(self, user_id, state, AI_name=None):
+        self.adaptor = None
+        self.user_id = str(user_id)
+        self.state = state
+        self._hand = card.CardSet()
+        self._face = None
+        self._role = None
+        self.is_AI = AI_name is not None
+        self.user = {"user_id": self.user_id, "username": AI_name or self.user_id}
+        self._AI = None
+        if self.is_AI:
+            from napoleon import AI
+            self._AI = getattr(AI, AI_name)(self)
+
+    def clone(self, state):
+        p = EnginePlayer.__new__(EnginePlayer)
+        p.adaptor = None
+        p.user_id = self.user_id
+        p.state = state
+        p._hand = self._hand
+        p._face = self._face
+        p._role = self._role
+        p.is_AI = self.is_AI
+        p.user = self.user
+        p._AI = self._AI and self._AI.__class__(p)
+        return p
+
+    def _play(self, c):
+        self._hand = self._hand - card.CardSet([c])
+        self.state.board = c
+        self.state.player_cards = (self.user_id, c)
+
+    def pass_(self):
+        if self.user_id not in self.state._pass_ids:
+            self.state._pass_ids.append(self.user_id)
+
+    @property
+    def hand(self):
+        return list(self._hand)
+
+    @hand.setter
+    def hand(self, hand):
+        self._hand = card.CardSet(hand)
+
+    @property
+    def number_of_hand(self):
+        return len(self._hand)
+
+    @property
+    def face(self):
+        return self._face
+
+    @face.setter
+    def face(self, value):
+        self._face = value
+
+    @property
+    def role(self):
+        return self._role
+
+    @role.setter
+    def role(self, role):
+        self._role = role
+
+
+class EnginePhase(Phase):
+
+    __slots__ = ("_current", "_waiting_next_turn")
+
+    def __init__(self, state):
+        self.state = state
+        self.adaptor = None
+        self._current = None
+        self._waiting_next_turn = False
+
+    @property
+    def current(self):
+        return self._current
+
+    @current.setter
+    def current(self, value):
+        self._current = value
+
+    @property
+    def waiting_next_turn(self):
+        return self._waiting_next_turn
+
+    @waiting_next_turn.setter
+    def waiting_next_turn(self, value):
+        self._waiting_next_turn = bool(value)
+
+
+class GameEngine(GameState):
+    """
+    :players: user ids in the same order as GameState.players
+    :AIs: {user_id: AI name}
+    """
+
+    __slots__ = (
+        "_players", "_player_map", "_pass_ids", "_rest", "_declaration", "_napoleon",
+        "_turn", "_adjutant", "_unused", "_board", "_player_cards", "_version",
+    )
+
+    def __init__(self, players, AIs=None):
+        AIs = AIs or {}
+        self.adaptor = None
+        self.room_id = None
+        self.phase = EnginePhase(self)
+        self._players = [EnginePlayer(uid, self, AIs.get(uid)) for uid in players]
+        self._player_map = {p.user_id: p for p in self._players}
+        self._pass_ids = []
+        self._rest = []
+        self._declaration = None
+        self._napoleon = None
+        self._turn = None
+        self._adjutant = None
+        self._unused = []
+        self._board = []  # the lead is the last as GameState.board
+        self._player_cards = {}
+        self._version = 0
+
+    def take_action(self, user_id, json):
+        """
+        :return: True if the state is changed
+        """
+        if phase.take_action(self, user_id, json):
+            self._version += 1
+            return True
+        return False
+
+    def clone(self):
+        e = GameEngine.__new__(GameEngine)
+        self._copy_to(e)
+        return e
+
+    def rollback(self, checkpoint):
+        """
+        Restore the state of checkpoint, which is a clone of this engine.
+        The checkpoint can be used again.
+        """
+        checkpoint._copy_to(self)
+
+    def _copy_to(self, e):
+        e.adaptor = None
+        e.room_id = self.room_id
+        if not isinstance(getattr(e, "phase", None), EnginePhase):
+            e.phase = EnginePhase(e)
+        e.phase._current = self.phase._current
+        e.phase._waiting_next_turn = self.phase._waiting_next_turn
+        e._players = [p.clone(e) for p in self._players]
+        e._player_map = {p.user_id: p for p in e._players}
+        e._pass_ids = list(self._pass_ids)
+        e._rest = list(self._rest)
+        e._declaration = self._declaration
+        e._napoleon = self._napoleon
+        e._turn = self._turn
+        e._adjutant = self._adjutant
+        e._unused = list(self._unused)
+        e._board = list(self._board)
+        e._player_cards = dict(self._player_cards)
+        e._version = self._version
+
+    def create_player(self, user_id):
+        if user_id is None:
+            raise ValueError("user_id must not be None")
+        return self._player_map[str(user_id)]
+
+    def flush(self):
+        pass
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def player_ids(self):
+        return [p.user_id for p in self._players]
+
+    @property
+    def players(self):
+        return list(self._players)
+
+    @property
+    def _passed_players(self):
+        return [p for p in self._players if p.user_id in self._pass_ids]
+
+    @_passed_players.deleter
+    def _passed_players(self):
+        self._pass_ids = []
+
+    @property
+    def rest(self):
+        return list(self._rest)
+
+    @rest.setter
+    def rest(self, rest):
+        self._rest = list(rest)
+
+    @property
+    def declaration(self):
+        return self._declaration
+
+    @declaration.setter
+    def declaration(self, declaration):
+        self._declaration = card.Declaration.from_int(int(declaration))
+
+    @property
+    def napoleon(self):
+        return self._napoleon
+
+    @napoleon.setter
+    def napoleon(self, user_id):
+        self._napoleon = str(user_id)
+
+    @property
+    def turn(self):
+        if self._turn:
+            return self._player_map[self._turn]
+
+    @turn.setter
+    def turn(self, user_id):
+        if isinstance(user_id, Player):
+            user_id = user_id.user_id
+        self._turn = str(user_id)
+
+    @property
+    def adjutant(self):
+        return self._adjutant
+
+    @adjutant.setter
+    def adjutant(self, adjutant):
+        self._adjutant = card.from_int(int(adjutant))
+
+    @property
+    def unused(self):
+        return list(self._unused)
+
+    @unused.setter
+    def unused(self, cards):
+        self._unused = list(cards)
+
+    @property
+    def board(self):
+        return list(self._board)
+
+    @board.setter
+    def board(self, c):
+        self._board.insert(0, c)
+
+    @board.deleter
+    def board(self):
+        self._board = []
+
+    @property
+    def player_cards(self):
+        return dict(self._player_cards)
+
+    @player_cards.setter
+    def player_cards(self, value):
+        user_id, c = value
+        self._player_cards[str(user_id)] = c
+
+    @player_cards.deleter
+    def player_cards(self):
+        self._player_cards = {}
@@ -1,3 +1,4 @@
+import functools
 import logging
 from collections import defaultdict
 
@@ -12,15 +13,25 @@ import tornado.websocket
 import tornado.escape
 
 from . import phase
+from . import delta
 from . state import GameState
-from . session import Session
-from . adaptor import RedisAdaptor
+from . session import Session, public_json, get_user_id, user_id_in_map
+from . async_adaptor import get_adaptor, transaction
+from . broadcast import broadcast
+from . scheduler import scheduler
+from . queue import queue
+from . metrics import metrics
 
 
 logger = logging.getLogger(__name__)
 
 
 class WSHandlerMixin(object):
+    """
+    The connections of a path are in this process,
+    so a message of a room is published to every process with broadcast
+    and each process writes it to its own connections.
+    """
     connections = defaultdict(set)
 
     @property
@@ -30,30 +41,64 @@ class WSHandlerMixin(object):
     def check_origin(self, origin):
         return True
 
+    @gen.coroutine
     def open(self, room_id):
         sid = self.get_cookie("sessionid")
-        WSHandlerMixin.connections[self.path].add((self, sid,))
         if sid.startswith("anonymous_"):
-            self.adaptor = RedisAdaptor(room_id, timer=settings.GAME_TIME_FOR_ANONYMOUS_PLAYER)
+            self.adaptor = get_adaptor(room_id, timer=settings.GAME_TIME_FOR_ANONYMOUS_PLAYER)
         else:
-            self.adaptor = RedisAdaptor(room_id)
-        self.state = GameState(self.adaptor)
+            self.adaptor = get_adaptor(room_id)
+        is_first = not WSHandlerMixin.connections[self.path]
+        WSHandlerMixin.connections[self.path].add((self, sid,))
+        if is_first:
+            yield broadcast.subscribe(self.path, self.__class__.on_broadcast)
 
+    @gen.coroutine
     def on_close(self):
         sid = self.get_cookie("sessionid")
-        WSHandlerMixin.connections[self.path].remove((self, sid,))
+        WSHandlerMixin.connections[self.path].discard((self, sid,))
+        if not WSHandlerMixin.connections[self.path]:
+            del WSHandlerMixin.connections[self.path]
+            yield broadcast.unsubscribe(self.path)
 
     def to_json(self, message):
         return tornado.escape.json_decode(message)
 
     @gen.coroutine
-    def write_on_same_room(self, message):
-        message = tornado.escape.json_encode(message)
-        for con, sid in WSHandlerMixin.connections[self.path]:
-            try:
-                con.write_message(message)
-            except tornado.websocket.WebSocketClosedError:
-                pass
+    def find_user_id(self, session_id):
+        """
+        Look up the sessions index without reading the whole room
+        :return: the user id of session_id in the room or None
+        """
+        user_id = yield self.adaptor.get_dict_item("sessions", session_id)
+        if user_id is None:
+            # a player who has joined before the sessions index
+            user_id = user_id_in_map((yield self.adaptor.get_dict("map")), session_id)
+        raise gen.Return(user_id or None)
+
+    @gen.coroutine
+    def write_on_same_room(self, message=None):
+        if message is None:
+            # only the room is changed
+            with metrics.measure("broadcast", "notify"):
+                yield broadcast.notify(self.path)
+        else:
+            with metrics.measure("broadcast", "publish"):
+                yield broadcast.publish(self.path, message)
+
+    @classmethod
+    @gen.coroutine
+    def on_broadcast(cls, path, message):
+        """
+        Write a published message to the connections of path in this process
+        """
+        with metrics.measure("broadcast", cls.__name__):
+            message = tornado.escape.json_encode(message)
+            for con, sid in list(WSHandlerMixin.connections[path]):
+                try:
+                    con.write_message(message)
+                except tornado.websocket.WebSocketClosedError:
+                    pass
 
 
 class GameHandler(WSHandlerMixin, WebSocketHandler):
@@ -62,24 +107,73 @@ class GameHandler(WSHandlerMixin, WebSocketHandler):
     Every time a player change a state, including a private state,
     all the player have to update the public state.
     Also there are some audience, and then they have to update it.
-    """
 
-    def _take_action(self, json, user_id):
-        action_name = json.pop("action", "")
-        action_class = phase.get_action(self.state.phase.current, action_name)
+    A client which connects with ?delta=1 gets a patch against the last state
+    sent to it instead of the whole state: {"version", "base", "patch"}.
+    It gets the whole state first and after it reports another version.
+    """
 
-        if not action_class:
-            return False
+    @gen.coroutine
+    def open(self, room_id):
+        self.delta = self.get_argument("delta", None) == "1"
+        # the last state sent to this connection
+        self.sent = None
+        # {session_id: user_id} which has been validated on this connection
+        self.user_ids = {}
+        yield super().open(room_id)
+
+    def _message(self, state):
+        if not self.delta:
+            return state
+        if self.sent is None:
+            message = state
+        else:
+            message = {"version": state["version"], "base": self.sent["version"], "patch": delta.diff(self.sent, state)}
+        self.sent = state
+        return message
 
-        # player must be without session
-        player = self.state.create_player(user_id)
-        action = action_class(player)
-        if action.can_next:
-            action.act(**json)
-            action.next()
-            return True
+    @gen.coroutine
+    def _take_action(self, json, user_id, session_id):
+        """
+        :return: None if the session is not of the user any more
+        """
+        def act(adaptor):
+            # the cached user id is validated in the room read by the transaction
+            if get_user_id(adaptor, session_id) != user_id:
+                return None
+            state = GameState(adaptor)
+            with metrics.measure("phase", state.phase.current):
+                return phase.take_action(state, user_id, json)
+
+        # read the room once, and write the changes in one transaction
+        # after the other actions of the room in this process
+        with metrics.measure("action", phase.action_name(json.get("action"))):
+            result = yield queue.run(self.adaptor.room_id, transaction, self.adaptor, act)
+        raise gen.Return(result)
 
-        return False
+    @gen.coroutine
+    def _get_user_id(self, session_id):
+        user_id = self.user_ids.get(session_id)
+        if user_id is None:
+            user_id = yield self.find_user_id(session_id)
+            if user_id:
+                self.user_ids[session_id] = user_id
+        raise gen.Return(user_id)
+
+    def _session(self, snapshot, session_id):
+        """
+        :return: the Session of this connection resolved through the cached user ids
+        """
+        user_id = self.user_ids.get(session_id)
+        if user_id is not None:
+            session = Session.of_user(snapshot, session_id, user_id)
+            if session:
+                return session
+            del self.user_ids[session_id]
+        session = Session(snapshot, session_id=session_id)
+        if session.is_valid:
+            self.user_ids[session_id] = session.user_id
+        return session
 
     @gen.coroutine
     def on_message(self, message):
@@ -91,42 +185,54 @@ class GameHandler(WSHandlerMixin, WebSocketHandler):
             raise gen.Return()
 
         sid = json.pop("session_id")
-        session = Session(self.adaptor, session_id=sid)
-        if session.user_id:
-            self._take_action(json, session.user_id)
-            yield self.write_on_same_room()
-            yield self.handle_ai()
-        else:
-            yield self.write_on_same_room()
-
+        version = json.pop("version", None)
+        if self.sent and version != self.sent["version"]:
+            # the client has missed a state
+            self.sent = None
+        user_id = yield self._get_user_id(sid)
+        if user_id:
+            result = yield self._take_action(json, user_id, sid)
+            if result is None:
+                # the user has quit or reset the session
+                del self.user_ids[sid]
+        yield self.write_on_same_room()
+        # AI players act in the background. a room of only AI players starts by a viewer,
+        # and it is paced while anyone watches it
+        scheduler.wake(self.adaptor, functools.partial(broadcast.notify, self.path),
+                       functools.partial(broadcast.is_watched, self.path))
+
+    @classmethod
     @gen.coroutine
-    def handle_ai(self):
-        """
-        If all the player AI have no action to the current state, then exit it.
-        Otherwise a player AI changes the state, so it needs to check whether
-        all the player AI have a action to the changed state. If at least one
-        of them have it, they act recusively.
-        """
-
-        for player in self.state.player_AIs:
-            json = player._AI.get_action()
-            if json:
-                logger.info("AI action: %s => %s" % (player, json))
-
-                # AI must wait for human's acitons here
-                yield gen.sleep(1)
-
-                if self._take_action(json, player.user_id):
-                    yield self.write_on_same_room()
-                    yield self.handle_ai()
-                    break
+    def on_broadcast(cls, path, message):
+        # a change of the room is published, and the state is read here once.
+        # the public state is computed once and each connection adds its private fields
+        connections = list(WSHandlerMixin.connections[path])
+        if not connections:
+            return
+        with metrics.measure("broadcast", cls.__name__):
+            snapshot = yield connections[0][0].adaptor.snapshot()
+            public = public_json(snapshot)
+            public_message = tornado.escape.json_encode(public)
+            for con, sid in connections:
+                session = con._session(snapshot, sid)
+                if con.delta:
+                    message = tornado.escape.json_encode(con._message(session.to_json(public)))
+                elif session.is_valid:
+                    message = tornado.escape.json_encode(session.to_json(public))
+                else:
+                    message = public_message
+                try:
+                    con.write_message(message)
+                except tornado.websocket.WebSocketClosedError:
+                    pass
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Returns the round trips to redis and the latency of the actions,
+    the phases and the broadcasts in this process.
+    The connections are instrumented and it is routed only with settings.REDIS_METRICS
+    """
 
-    @gen.coroutine
-    def write_on_same_room(self):
-        for con, sid in WSHandlerMixin.connections[self.path]:
-            session = Session(self.adaptor, session_id=sid)
-            message = tornado.escape.json_encode(session.state.to_json())
-            try:
-                con.write_message(message)
-            except tornado.websocket.WebSocketClosedError:
-                pass
+    def get(self):
+        self.write(metrics.to_json())
@@ -0,0 +1,326 @@
+"""
+Load test of websockets with many rooms at once.
+
+    python manage.py loadtest --rooms 50 --humans 2 --AIs 3
+
+The rooms are created and joined through the views of napoleon.room,
+and the tornado app of main_tornado.make_rootings is started in this process
+on a local redis. Each human player plays at random over /ws/<room_id>
+and chats over /chat/<room_id> until all the rooms are finished.
+
+The report has the actions per second, the percentiles of the latency
+from sending an action to getting the changed state, and the memory
+per connection. The memory includes both the server and the clients
+because they run in the same process.
+"""
+import asyncio
+import json
+import logging
+import random
+import resource
+import time
+
+from tornado.httpclient import HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.web import Application
+from tornado.websocket import websocket_connect
+
+from napoleon.game import card
+from napoleon.game.adaptor import get_adaptor
+from napoleon.game.scheduler import scheduler
+
+
+logger = logging.getLogger(__name__)
+
+USERNAME = "loadtest{i}"
+
+PASSWORD = "loadtest"
+
+
+def rss():
+    """
+    :return: the resident memory of this process in bytes
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # the peak instead on the other platforms
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    """
+    :return: {p: the value of the percentile p}
+    """
+    values = sorted(values)
+    if not values:
+        return {p: None for p in ps}
+    return {p: values[min(len(values) - 1, len(values) * p // 100)] for p in ps}
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.actions = 0
+        self.chats = 0
+        self.messages = 0
+        # seconds from sending a message to getting its broadcast
+        self.latencies = []
+        self.chat_latencies = []
+        # {room_id: [the first version, the last version]} of the states
+        self.versions = {}
+        self.finished = set()
+
+    def report(self, seconds, connections, memory):
+        """
+        :memory: bytes which the connections take
+        """
+        return {
+            "seconds": seconds,
+            "actions_per_second": self.actions / seconds,
+            "changes_per_second": sum(last - first for first, last in self.versions.values()) / seconds,
+            "messages_per_second": self.messages / seconds,
+            "latency_ms": {p: v and v * 1000 for p, v in percentiles(self.latencies).items()},
+            "chat_latency_ms": {p: v and v * 1000 for p, v in percentiles(self.chat_latencies).items()},
+            "rooms_finished": len(self.finished),
+            "connections": connections,
+            "memory_per_connection_kb": memory / max(connections, 1) / 1024,
+        }
+
+
+def decide(state, rng):
+    """
+    :state: a state which a player gets on /ws
+    :return: an action of the player who plays at random, or None
+    """
+    players = state["players"]
+    me = next((p for p in players if p.get("is_valid")), None)
+    if me is None:
+        return None
+    phase = state["phase"]["current"]
+    humans = [p["user_id"] for p in players if not p["is_AI"]]
+    is_first = humans and humans[0] == me["user_id"]
+    hand = [c["value"] for c in me["hand"]]
+
+    if phase is None:
+        if is_first and state["phase"]["is_appropriate_player_number"]:
+            return {"action": "start"}
+    elif phase == "declare":
+        if me["is_passed"]:
+            return None
+        if is_first and not state["declaration"]:
+            suits = [card.from_int(v).suit for v in hand]
+            suit = max(card.Suit, key=suits.count)
+            return {"action": "declare", "declaration": int(card.Declaration(13, suit))}
+        return {"action": "pass"}
+    elif phase == "adjutant":
+        if me["is_napoleon"]:
+            return {"action": "adjutant", "adjutant": int(rng.choice(card.deck))}
+    elif phase == "discard":
+        if me["is_napoleon"]:
+            return {"action": "discard", "unused": rng.sample(hand, card.REST[len(players)])}
+    elif phase in ["first_round", "rounds"]:
+        if me["is_my_turn"] and me["possible_cards"]:
+            return {"action": "select", "selected": rng.choice(me["possible_cards"])["value"]}
+    return None
+
+
+class Player(object):
+    """
+    A human player of a room on websockets
+    :chat_every: the number of actions between the chat messages, or 0
+    """
+
+    def __init__(self, room_id, session_id, stats, rng, chat_every=0):
+        self.room_id = room_id
+        self.session_id = session_id
+        self.stats = stats
+        self.rng = rng
+        self.chat_every = chat_every
+        self.ws = None
+        self.chat = None
+        # the version which this player has acted on, and when
+        self.acted = None
+        self.sent_at = None
+        # the chat message which this player has sent, and when
+        self.said = None
+        self.said_at = None
+
+    def request(self, url):
+        return HTTPRequest(url, headers={"Cookie": "sessionid=%s" % self.session_id})
+
+    async def connect(self, base_url):
+        self.ws = await websocket_connect(self.request("%s/ws/%s" % (base_url, self.room_id)))
+        self.chat = await websocket_connect(self.request("%s/chat/%s" % (base_url, self.room_id)))
+
+    def send(self, json_):
+        json_ = dict(json_, session_id=self.session_id)
+        self.ws.write_message(json.dumps(json_))
+
+    async def play(self):
+        """
+        Play until the game is finished or the connection is closed
+        """
+        listening = asyncio.ensure_future(self.listen())
+        # a message without an action makes the room send the state
+        self.send({})
+        try:
+            await self._play()
+        finally:
+            listening.cancel()
+
+    async def _play(self):
+        actions = 0
+        while True:
+            message = await self.ws.read_message()
+            if message is None:
+                return
+            self.stats.messages += 1
+            state = json.loads(message)
+            version = state["version"] or 0
+            self.stats.versions.setdefault(self.room_id, [version, version])[1] = version
+            if self.sent_at is not None and version > self.acted:
+                self.stats.latencies.append(time.perf_counter() - self.sent_at)
+                self.sent_at = None
+            if state["phase"]["current"] == "finished":
+                self.stats.finished.add(self.room_id)
+                return
+            if version == self.acted:
+                continue
+            action = decide(state, self.rng)
+            if action:
+                self.acted = version
+                self.sent_at = time.perf_counter()
+                self.stats.actions += 1
+                self.send(action)
+                actions += 1
+                if self.chat_every and actions % self.chat_every == 0 and self.said is None:
+                    self.say("%x-%d" % (id(self), actions))
+
+    def say(self, msg):
+        self.said = msg
+        self.said_at = time.perf_counter()
+        self.chat.write_message(json.dumps({"session_id": self.session_id, "msg": msg}))
+
+    async def listen(self):
+        # the messages of the other players in the room come too
+        while True:
+            message = await self.chat.read_message()
+            if message is None:
+                return
+            messages = json.loads(message)["messages"]
+            if self.said is not None and any(m["msg"] == self.said for m in messages):
+                self.stats.chats += 1
+                self.stats.chat_latencies.append(time.perf_counter() - self.said_at)
+                self.said = None
+
+    def close(self):
+        for ws in [self.ws, self.chat]:
+            if ws is not None:
+                ws.close()
+
+
+def create_rooms(rooms, humans, AIs, AI_names):
+    """
+    Create the rooms and join them through the views
+    :return: [(room_id, [session_id of the humans])]
+    """
+    from django.contrib.auth.models import User
+    from django.core.urlresolvers import reverse
+    from django.test import Client
+    from napoleon.room.models import Room
+
+    clients = []
+    for i in range(humans):
+        user, created = User.objects.get_or_create(username=USERNAME.format(i=i))
+        if created:
+            user.set_password(PASSWORD)
+            user.save()
+        client = Client(enforce_csrf_checks=False)
+        if not client.login(username=user.username, password=PASSWORD):
+            raise ValueError("%s can't log in" % user.username)
+        clients.append(client)
+
+    result = []
+    for _ in range(rooms):
+        room = Room.objects.create(label="loadtest", user=User.objects.get(username=USERNAME.format(i=0)))
+        for client in clients:
+            client.post(reverse("napoleon.room.views.join", kwargs={"room_id": room.id}))
+        for i in range(AIs):
+            clients[0].post(reverse("napoleon.room.views.add", kwargs={"room_id": room.id}),
+                            {"name": AI_names[i % len(AI_names)]})
+        result.append((room.id, [c.cookies["sessionid"].value for c in clients]))
+    return result
+
+
+def delete_rooms(room_ids):
+    from napoleon.room.models import Room
+    for room_id in room_ids:
+        get_adaptor(room_id).flush()
+    Room.objects.filter(id__in=room_ids).delete()
+
+
+async def load(rooms, port=8765, timeout=300, seed=0, chat_every=0):
+    """
+    :rooms: [(room_id, [session_id])] which create_rooms returns
+    :port: 0 to listen on an unused port
+    :return: a report of Stats
+    """
+    from main_tornado import make_rootings
+
+    sockets = bind_sockets(port, "localhost")
+    port = sockets[0].getsockname()[1]
+    server = HTTPServer(Application(make_rootings()))
+    server.add_sockets(sockets)
+    base_url = "ws://localhost:%d" % port
+    stats = Stats()
+    rng = random.Random(seed)
+    players = [
+        Player(room_id, sid, stats, random.Random(rng.random()), chat_every)
+        for room_id, session_ids in rooms
+        for sid in session_ids
+    ]
+    try:
+        before = rss()
+        for p in players:
+            await p.connect(base_url)
+        memory = rss() - before
+
+        start = time.perf_counter()
+        done, pending = await asyncio.wait([asyncio.ensure_future(p.play()) for p in players], timeout=timeout)
+        seconds = time.perf_counter() - start
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception():
+                logger.error("A player failed", exc_info=task.exception())
+    finally:
+        for p in players:
+            p.close()
+        server.stop()
+    return stats.report(seconds, len(players) * 2, memory)
+
+
+def run(rooms=10, humans=2, AIs=3, AI_names=("RandomMan",), port=8765, timeout=300, seed=0,
+        chat_every=0, AI_delay=0):
+    """
+    :AI_delay: seconds an AI player waits before each action
+    :return: a report
+    """
+    if humans < 1:
+        raise ValueError("A room needs a human player to be driven over websockets")
+    if humans + AIs not in card.RANGE_OF_PLAYERS:
+        raise ValueError("The number of players must be in %s" % list(card.RANGE_OF_PLAYERS))
+
+    created = create_rooms(rooms, humans, AIs, list(AI_names))
+    delay = scheduler._delay
+    scheduler._delay = AI_delay
+    try:
+        return IOLoop.current().run_sync(
+            lambda: load(created, port=port, timeout=timeout, seed=seed, chat_every=chat_every))
+    finally:
+        scheduler._delay = delay
+        delete_rooms([room_id for room_id, _ in created])
@@ -0,0 +1,207 @@
+"""
+Round trips to redis and latency of the game.
+
+An instrumented connection records every command in the scopes
+which are being measured, so that the cost of an action, a phase
+or a broadcast is seen per name:
+
+    instrument()
+    with metrics.measure("action", "declare"):
+        ...
+    metrics.to_json()
+
+A test records a block without adding it to the metrics:
+
+    with recording() as record:
+        phase.take_action(GameState(RedisAdaptor(room_id, conn=Instrumented(conn))), ...)
+    assert record.round_trips <= 3
+"""
+import contextlib
+import contextvars
+import inspect
+import time
+
+from django.conf import settings
+
+
+# the records of the scopes which the current task is in
+_scopes = contextvars.ContextVar("scopes", default=())
+
+
+def _size(value):
+    """
+    :return: approximate bytes of a command argument or a reply
+    """
+    if value is None:
+        return 0
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, (list, tuple, set)):
+        return sum(_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_size(k) + _size(v) for k, v in value.items())
+    return len(str(value).encode("utf-8"))
+
+
+class Record(object):
+    """
+    :round_trips: requests to redis. A pipeline is one request
+    :commands: commands in the requests
+    :seconds: the time of the scope, and redis_seconds is the time waiting for redis in it
+    """
+
+    __slots__ = ("calls", "round_trips", "commands", "bytes_sent", "bytes_received",
+                 "seconds", "redis_seconds", "max_seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.round_trips = 0
+        self.commands = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seconds = 0.0
+        self.redis_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, other):
+        for name in self.__slots__:
+            if name != "max_seconds":
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.max_seconds = max(self.max_seconds, other.seconds)
+
+    def to_json(self):
+        """
+        :return: the averages per call
+        """
+        calls = self.calls or 1
+        return {
+            "calls": self.calls,
+            "round_trips": self.round_trips / calls,
+            "commands": self.commands / calls,
+            "bytes_sent": self.bytes_sent / calls,
+            "bytes_received": self.bytes_received / calls,
+            "ms": self.seconds / calls * 1000,
+            "redis_ms": self.redis_seconds / calls * 1000,
+            "max_ms": self.max_seconds * 1000,
+        }
+
+
+def _record(commands, sent, reply, start):
+    seconds = time.perf_counter() - start
+    received = _size(reply)
+    for record in _scopes.get():
+        record.round_trips += 1
+        record.commands += commands
+        record.bytes_sent += sent
+        record.bytes_received += received
+        record.redis_seconds += seconds
+
+
+def _recorded(func, commands, sent):
+    """
+    :return: func which records a round trip, on a blocking or an async connection
+    """
+    def recorded(*args, **kwargs):
+        # the queued commands are counted before the pipeline is cleared
+        n, size = commands(), sent(args)
+        start = time.perf_counter()
+        reply = func(*args, **kwargs)
+        if not inspect.isawaitable(reply):
+            _record(n, size, reply, start)
+            return reply
+
+        async def wait():
+            result = await reply
+            _record(n, size, result, start)
+            return result
+        return wait()
+    return recorded
+
+
+class Instrumented(object):
+    """
+    A blocking or an async connection which records the commands.
+    A pipeline is recorded when it is executed or sends a command at once while watching.
+    """
+
+    # they don't send a command to redis
+    not_commands = {"pipeline", "pubsub", "register_script", "get_encoder", "get_connection_kwargs"}
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def pipeline(self, *args, **kwargs):
+        pipe = self.conn.pipeline(*args, **kwargs)
+        pipe.execute = _recorded(
+            pipe.execute,
+            lambda: len(pipe.command_stack),
+            lambda args: _size([a for a, _ in pipe.command_stack]),
+        )
+        pipe.immediate_execute_command = _recorded(pipe.immediate_execute_command, lambda: 1, _size)
+        return pipe
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if not callable(attr) or name in self.not_commands:
+            return attr
+        return _recorded(attr, lambda: 1, _size)
+
+
+class Metrics(object):
+
+    def __init__(self):
+        # {(kind, name): Record}
+        self.records = {}
+
+    @contextlib.contextmanager
+    def measure(self, kind, name):
+        """
+        Add the commands and the time of the block to the record of kind and name
+        :return: a Record of the block
+        """
+        with recording() as record:
+            yield record
+        self.records.setdefault((kind, name), Record()).add(record)
+
+    def reset(self):
+        self.records = {}
+
+    def to_json(self):
+        """
+        :return: {kind: {name: the averages per call}}
+        """
+        json = {}
+        for (kind, name), record in sorted(self.records.items(), key=lambda i: (i[0][0], str(i[0][1]))):
+            json.setdefault(kind, {})[str(name)] = record.to_json()
+        return json
+
+
+@contextlib.contextmanager
+def recording():
+    """
+    Record the commands sent through the instrumented connections in the block,
+    including the ones of nested scopes
+    :return: a Record of the block
+    """
+    record = Record()
+    record.calls = 1
+    token = _scopes.set(_scopes.get() + (record,))
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = record.max_seconds = time.perf_counter() - start
+        _scopes.reset(token)
+
+
+def instrument():
+    """
+    Instrument the connections in settings
+    """
+    if not isinstance(settings.REDIS_CONNECTION, Instrumented):
+        settings.REDIS_CONNECTION = Instrumented(settings.REDIS_CONNECTION)
+    if not isinstance(settings.REDIS_ASYNC_CONNECTION, Instrumented):
+        settings.REDIS_ASYNC_CONNECTION = Instrumented(settings.REDIS_ASYNC_CONNECTION)
+
+
+metrics = Metrics()
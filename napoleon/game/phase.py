@@ -12,6 +12,41 @@ def get_action(phase, action=None):
         return action_class
 
 
+def action_name(action):
+    """
+    A name given by a client is recorded only if an action class is of it
+    :return: the name of the action class, or "invalid"
+    """
+    action_class = globals().get("%sAction" % str(action).title())
+    if isinstance(action_class, type) and issubclass(action_class, Action) and action_class is not Action:
+        return action_class.__name__[:-len("Action")].lower()
+    return "invalid"
+
+
+def take_action(state, user_id, json):
+    """
+    A player takes an action if it is appropriate to the current phase.
+    :json: {"action": ACTION_NAME, "arg1": ARG1, ...}
+    :return: True if the state is changed
+    """
+    json = dict(json)
+    action_name = json.pop("action", "")
+    action_class = get_action(state.phase.current, action_name)
+
+    if not action_class:
+        return False
+
+    # player must be without session
+    player = state.create_player(user_id)
+    action = action_class(player)
+    if action.can_next:
+        action.act(**json)
+        action.next()
+        return True
+
+    return False
+
+
 class Action(object):
     phases = []
     next_phase = ""
@@ -0,0 +1,41 @@
+"""
+Actions of a room in order in this process.
+
+The coroutines of a room can interleave at every await, so an action
+waits for the actions of the same room before it:
+
+    result = await queue.run(room_id, transaction, adaptor, func)
+
+The actions of different rooms don't wait for each other.
+"""
+import asyncio
+
+
+class RoomQueue(object):
+
+    def __init__(self):
+        self.locks = {}
+        self.waiting = {}
+
+    async def run(self, room_id, func, *args):
+        """
+        :func: a coroutine function which takes args
+        :return: the result of func
+        """
+        if room_id not in self.locks:
+            self.locks[room_id] = asyncio.Lock()
+            self.waiting[room_id] = 0
+        lock = self.locks[room_id]
+        self.waiting[room_id] += 1
+        try:
+            # a lock wakes up the waiters in order
+            async with lock:
+                return await func(*args)
+        finally:
+            self.waiting[room_id] -= 1
+            if not self.waiting[room_id]:
+                del self.locks[room_id]
+                del self.waiting[room_id]
+
+
+queue = RoomQueue()
@@ -0,0 +1,161 @@
+"""
+Actions of AI players in the background.
+
+A handler wakes the scheduler of a room after it commits a change,
+and returns without waiting for the AI players:
+
+    scheduler.wake(adaptor, on_change, is_watched)
+
+A room has at most one task, which takes the actions of AI players
+one by one until none of them has an action.
+A room of only AI players which nobody watches is fast-forwarded: the actions
+are taken back to back and a batch of them is written in one transaction.
+The decisions which take long are made in processes (see napoleon.AI.executor).
+"""
+import asyncio
+import functools
+import logging
+
+from django.conf import settings
+
+from napoleon.AI.executor import executor
+from napoleon.game import phase
+from napoleon.game.state import GameState
+from napoleon.game.async_adaptor import transaction
+from napoleon.game.queue import queue
+from napoleon.game.metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def next_action(state):
+    """
+    :return: (user_id, json) of the first AI player which has an action, or None
+    """
+    for player in state.player_AIs:
+        json = player._AI.get_action()
+        if json:
+            return player.user_id, json
+
+
+def take_actions(state, number=1):
+    """
+    :return: the number of actions which AI players take
+    """
+    for i in range(number):
+        action = next_action(state)
+        if not action:
+            return i
+        user_id, json = action
+        logger.debug("AI action: %s => %s" % (user_id, json))
+        if not phase.take_action(state, user_id, json):
+            return i
+    return number
+
+
+def take_decided_action(adaptor, version, action, number=1):
+    """
+    :version: the version of the room where action is decided
+    :number: the number of actions including action.
+             The others are decided here unless an AI player is heavy
+    :return: the number of actions which AI players take,
+             or None if the room is changed after version
+    """
+    state = GameState(adaptor)
+    if state.version != version:
+        return None
+    user_id, json = action
+    logger.debug("AI action: %s => %s" % (user_id, json))
+    if not phase.take_action(state, user_id, json):
+        return 0
+    if number > 1 and not any(executor.is_heavy(p) for p in state.player_AIs):
+        return 1 + take_actions(state, number - 1)
+    return 1
+
+
+def is_fast_forward(state):
+    """
+    :return: True if no human plays the room. The viewers are asked by the scheduler
+    """
+    players = state.players
+    return bool(players) and all(p.is_AI for p in players)
+
+
+class AIScheduler(object):
+    """
+    :delay: seconds an AI player waits before each action
+            so that humans can follow it. settings.AI_DELAY by default
+    :batch: the number of actions taken in one transaction without waiting
+            in a room of only AI players. settings.AI_FAST_FORWARD_BATCH by default
+    """
+
+    def __init__(self, delay=None, batch=None):
+        self._delay = delay
+        self._batch = batch
+        self.tasks = {}
+        self.woken = set()
+
+    @property
+    def delay(self):
+        return settings.AI_DELAY if self._delay is None else self._delay
+
+    @property
+    def batch(self):
+        return settings.AI_FAST_FORWARD_BATCH if self._batch is None else self._batch
+
+    def wake(self, adaptor, on_change, is_watched=None):
+        """
+        :adaptor: an async adaptor of a room
+        :on_change: a coroutine function called after an AI player changes the room
+        :is_watched: a coroutine function which returns True while someone watches the room.
+                     A room without it is not watched
+        :return: the task of the room
+        """
+        room_id = adaptor.room_id
+        self.woken.add(room_id)
+        if room_id not in self.tasks:
+            self.tasks[room_id] = asyncio.ensure_future(self._run(adaptor, on_change, is_watched))
+        return self.tasks[room_id]
+
+    async def _run(self, adaptor, on_change, is_watched=None):
+        room_id = adaptor.room_id
+        try:
+            while True:
+                self.woken.discard(room_id)
+                snapshot = await adaptor.snapshot()
+                state = GameState(snapshot)
+                action = await executor.next_action(state)
+                if action is None:
+                    if room_id in self.woken:
+                        # the room is changed while reading it
+                        continue
+                    break
+
+                if is_fast_forward(state) and not (is_watched and await is_watched()):
+                    # the viewers who come later get a state per batch
+                    number = self.batch
+                    await asyncio.sleep(0)
+                else:
+                    number = 1
+                    await asyncio.sleep(self.delay)
+                act = functools.partial(take_decided_action, version=state.version, action=action, number=number)
+                with metrics.measure("AI", action[1].get("action")):
+                    count = await queue.run(room_id, transaction, adaptor, act)
+                if count:
+                    await on_change()
+                elif count is None or room_id in self.woken:
+                    # the action is decided on an old room
+                    continue
+                else:
+                    logger.warning("AI action is rejected on room %s: %s" % (room_id, action))
+                    break
+        except Exception:
+            # the room stops until the next change, and the others keep going
+            logger.exception("AI failed on room %s" % room_id)
+        finally:
+            del self.tasks[room_id]
+            self.woken.discard(room_id)
+
+
+scheduler = AIScheduler()
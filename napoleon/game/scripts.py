@@ -0,0 +1,48 @@
+"""
+Lua scripts which change a room key atomically in one round trip.
+"""
+import weakref
+
+PUSH_UNIQUE = """
+-- KEYS: list
+-- ARGV: value, 1 to delete the list first, timer
+-- :return: 1 if the value is pushed, or 0 if it is already in the list
+local pushed = 1
+if ARGV[2] == "1" then
+    redis.call("DEL", KEYS[1])
+else
+    for _, v in ipairs(redis.call("LRANGE", KEYS[1], 0, -1)) do
+        if v == ARGV[1] then
+            pushed = 0
+            break
+        end
+    end
+end
+if pushed == 1 then
+    redis.call("LPUSH", KEYS[1], ARGV[1])
+end
+if tonumber(ARGV[3]) > 0 then
+    redis.call("EXPIRE", KEYS[1], ARGV[3])
+end
+return pushed
+"""
+
+
+class Scripts(object):
+
+    def __init__(self, conn):
+        self.push_unique = conn.register_script(PUSH_UNIQUE)
+
+
+# dropped with the connection
+_scripts = weakref.WeakKeyDictionary()
+
+
+def get_scripts(conn):
+    """
+    :return: Scripts registered once per connection
+    """
+    scripts = _scripts.get(conn)
+    if scripts is None:
+        scripts = _scripts[conn] = Scripts(conn)
+    return scripts
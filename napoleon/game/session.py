@@ -1,10 +1,22 @@
 import enum
+import operator
+
+from napoleon.game import card
 from napoleon.game.state import GameState
 
 
+# cards are interned, so their JSON is made once
+_card_json = {}
+
+
 def to_json(obj):
     if isinstance(obj, (int, str)):
         return obj
+    elif isinstance(obj, card.Mixin):
+        key = (obj.__class__, int(obj))
+        if key not in _card_json:
+            _card_json[key] = obj.to_json()
+        return _card_json[key]
     elif isinstance(obj, list):
         return [to_json(o) for o in obj]
     elif isinstance(obj, dict):
@@ -18,6 +30,117 @@ def to_json(obj):
         return None
 
 
+class Field(object):
+    """
+    A field of a schema.
+    :name: the key in JSON and the attribute of an object by default
+    :get: a function which takes an object and a session
+    :visible: a function which takes an object and a session
+              and returns False if the viewer can't see the value
+    :hidden: the value which the viewer gets instead
+    :private: True if the value depends on the viewer
+    :dump: a function which makes the value into JSON
+    """
+
+    def __init__(self, name, get=None, visible=None, hidden=None, private=False, dump=to_json):
+        self.name = name
+        if get is None:
+            attribute = operator.attrgetter(name)
+            get = lambda obj, session: attribute(obj)
+        self.get = get
+        self.visible = visible
+        self.hidden = hidden
+        self.private = private or visible is not None
+        self.dump = dump
+
+
+class Schema(object):
+    """
+    Declares the fields of an object in JSON
+    """
+
+    def __init__(self, *fields):
+        self.fields = [f if isinstance(f, Field) else Field(f) for f in fields]
+        self.private_fields = [f for f in self.fields if f.private]
+        self.names = {f.name: f for f in self.fields}
+
+    def to_json(self, obj, session, fields=None):
+        d = {}
+        for f in fields or self.fields:
+            if f.visible is None or f.visible(obj, session):
+                d[f.name] = f.dump(f.get(obj, session))
+            else:
+                d[f.name] = f.dump(f.hidden)
+        return d
+
+    def private_json(self, obj, session):
+        return self.to_json(obj, session, self.private_fields)
+
+
+def _is_myself(player, session):
+    return session.is_valid and session.user_id == player.user_id
+
+
+def _is_napoleon(state, session):
+    return session.is_valid and session.user_id == state.napoleon
+
+
+PHASE = Schema(
+    "are_all_players_passed",
+    "current",
+    "did_allied_forces_win",
+    "did_napoleon_forces_win",
+    "is_appropriate_player_number",
+    "is_finished",
+    "is_napoleon_determined",
+    "waiting_next_turn",
+)
+
+PLAYER = Schema(
+    "current_card",
+    "face",
+    Field("hand", visible=_is_myself, hidden=[]),
+    "is_AI",
+    "is_allied_forces",
+    "is_joined",
+    "is_my_turn",
+    "is_napoleon",
+    "is_napoleon_forces",
+    "is_passed",
+    Field("is_valid", get=_is_myself, private=True),
+    "is_winner",
+    "number_of_hand",
+    Field("possible_cards", visible=_is_myself, hidden=[]),
+    "role",
+    "user",
+    "user_id",
+)
+
+STATE = Schema(
+    "adjutant",
+    "board",
+    "declaration",
+    "napoleon",
+    "number_of_face_cards_of_allied_forces",
+    "number_of_face_cards_of_napoleon_forces",
+    Field("phase", get=lambda state, session: PHASE.to_json(state.phase, session), dump=None),
+    "player_AIs",
+    "player_cards",
+    Field("players", get=lambda state, session: [PLAYER.to_json(p, session) for p in state.players], dump=None),
+    Field("rest", visible=_is_napoleon, hidden=[]),
+    "room_id",
+    "turn",
+    "turn_user_id",
+    Field("unused", visible=_is_napoleon, hidden=[]),
+    "unused_faces",
+    "version",
+)
+
+for f in PHASE.fields + STATE.fields:
+    if f.dump is None:
+        f.dump = lambda value: value
+
+
 class Session(object):
 
     def __init__(self, adaptor, session_id=None, user_id=None):
@@ -40,6 +163,19 @@ class Session(object):
         else:
             self.user_id = user_id
 
+    @classmethod
+    def of_user(cls, adaptor, session_id, user_id):
+        """
+        :user_id: the user id which a connection has cached for session_id
+        :return: a valid Session, or None if it is not the session of the user any more
+        """
+        if adaptor.get_dict_item("map", user_id) != session_id:
+            return None
+        session = cls(adaptor)
+        session.user_id = str(user_id)
+        session.is_valid = True
+        return session
+
     @property
     def myself(self):
         if self.user_id:
@@ -54,102 +190,102 @@ class Session(object):
         state = GameState(self.adaptor)
         return PlayerWithSession(state, session)
 
+    def to_json(self, public=None):
+        """
+        :public: the JSON of public_json() which all the viewers share.
+                 Then only the private fields of this session are computed.
+        """
+        state = GameState(self.adaptor)
+        if public is None:
+            return STATE.to_json(state, self)
+        if not (self.is_valid and self.user_id):
+            return public
+
+        d = dict(public)
+        d.update(STATE.private_json(state, self))
+        players = []
+        for p in public["players"]:
+            if p["user_id"] == self.user_id:
+                p = dict(p)
+                p.update(PLAYER.private_json(state.create_player(self.user_id), self))
+            players.append(p)
+        d["players"] = players
+        return d
+
+
+def public_json(adaptor):
+    """
+    :return: the JSON of a state which anyone can see
+    """
+    return Session(adaptor).to_json()
+
 
 def get_user_id(adaptor, session_id):
-    user_dict = adaptor.get_dict("map")
-    inv = {v: k for k, v in user_dict.items()}
-    user_id = inv.get(session_id)
+    user_id = adaptor.get_dict_item("sessions", session_id)
+    if user_id is None:
+        # a player who has joined before the sessions index
+        user_id = user_id_in_map(adaptor.get_dict("map"), session_id)
     if user_id:
         return user_id
 
 
-class PlayerPrivilege(object):
-
-    def __init__(self, session):
-        self.session = session
-
-    def role(self, value):
-        p = self.session.myself
-        if p or p.state.phase.current == "finished":
-            return value
-        return None
-
-    def possible_cards(self, value):
-        return value if self.session.is_valid else []
-
-    def hand(self, value):
-        return value if self.session.is_valid else []
-
-
-class StatePrivilege(object):
-
-    def __init__(self, session):
-        self.session = session
-
-    def rest(self, value):
-        p = self.session.myself
-        return value if self.session.is_valid and p.is_napoleon else []
-
-    def unused(self, value):
-        p = self.session.myself
-        return value if self.session.is_valid and p.is_napoleon else []
-
-    def players(self, value):
-        p = self.session.myself
-        return [p if p and p.user_id == v.user_id else
-                self.session.create_player(v.user_id) for v in value]
+def user_id_in_map(user_map, session_id):
+    """
+    :user_map: {user_id: session_id}
+    """
+    for user_id, sid in user_map.items():
+        if sid == session_id:
+            return user_id
 
 
 class PlayerWithSession(object):
+    """
+    A player whose private fields are hidden from the session
+    """
 
     def __init__(self, state, session):
         self.state = GameStateWithSession(session)
         self.player = state.create_player(session.user_id)
-        self.privilege = PlayerPrivilege(session)
-        self.is_valid = session.is_valid
+        self.session = session
 
     def to_json(self):
-        # GameState has a players attribute.
-        # so state must be ignored here so as not to be recurcively called
-        keys = dir(self.player) + ["is_valid"]
-        return to_json({key: getattr(self, key) for key in keys if key != "state"})
+        return PLAYER.to_json(self.player, self.session)
 
     def __getattr__(self, name):
-        meth = getattr(self.privilege, name, None)
-        value = getattr(self.player, name)
-        if meth:
-            return meth(value)
-        else:
-            return value
+        field = PLAYER.names.get(name)
+        if field and field.private:
+            return PLAYER.to_json(self.player, self.session, [field])[name]
+        return getattr(self.player, name)
 
 
 class GameStateWithSession(object):
+    """
+    A state whose private fields are hidden from the session
+    """
 
     def __init__(self, session):
         self.state = GameState(session.adaptor)
         self.phase = PhaseWithSession(self.state, session)
-        self.privilege = StatePrivilege(session)
-
-    def __getattr__(self, name):
-        meth = getattr(self.privilege, name, None)
-        value = getattr(self.state, name)
-        if meth:
-            return meth(value)
-        else:
-            return value
+        self.session = session
 
     def to_json(self):
-        return to_json({key: getattr(self, key) for key in dir(self.state)})
+        return STATE.to_json(self.state, self.session)
+
+    def __getattr__(self, name):
+        field = STATE.names.get(name)
+        if field and field.private:
+            return STATE.to_json(self.state, self.session, [field])[name]
+        return getattr(self.state, name)
 
 
 class PhaseWithSession(object):
 
     def __init__(self, state, session):
         self.phase = state.phase
+        self.session = session
 
     def to_json(self):
-        return to_json({key: getattr(self, key) for key in dir(self.phase) if key != "state"})
+        return PHASE.to_json(self.phase, self.session)
 
     def __getattr__(self, name):
-        value = getattr(self.phase, name)
-        return value
+        return getattr(self.phase, name)
@@ -1,3 +1,4 @@
+import contextlib
 import enum
 import logging
 
@@ -8,6 +9,19 @@ from napoleon.game.adaptor import RedisAdaptor
 logger = logging.getLogger(__name__)
 
 
+@contextlib.contextmanager
+def _batch(state):
+    """
+    :return: a GameState whose writes are sent at once on exit
+    """
+    if not hasattr(state.adaptor, "batch"):
+        # GameEngine has no adaptor
+        yield state
+        return
+    with state.adaptor.batch() as adaptor:
+        yield state if adaptor is state.adaptor else GameState(adaptor)
+
+
 class Role(enum.Enum):
     napoleon_forces = 1
     allied_forces = 2
@@ -15,6 +29,8 @@ class Role(enum.Enum):
 
 class Player(object):
 
+    __slots__ = ("adaptor", "user_id", "state")
+
     def __init__(self, user_id, state):
         user_id = str(user_id)
         if user_id is None:
@@ -81,6 +97,9 @@ class Player(object):
             else:
                 self.role = Role.napoleon_forces
 
+        self._play(card)
+
+    def _play(self, card):
         self.adaptor.rem_list("hand", int(card))
         self.state.board = card
         self.state.player_cards = (self.user_id, card)
@@ -106,20 +125,24 @@ class Player(object):
         if not d or int(d) < int(declaration):
             self.state.declaration = declaration
             self.state.napoleon = self.user_id
-            self.state.turn = Player(self.user_id, self.state)
+            self.state.turn = self
 
     def decide(self, adjutant):
         self.state.adjutant = adjutant
 
     def discard(self, unused):
-        hand = self.hand
-        for u in unused:
-            try:
-                hand.remove(u)
-            except ValueError:
-                raise ValueError("A player can't discard a card he doesn't have.")
-
-        self.hand = hand
+        hand = card.CardSet(self.hand)
+        number = len(unused)
+        unused = card.CardSet(unused)
+        # a CardSet merges the same cards
+        if len(unused) != number:
+            raise ValueError("A player can't discard the same card twice.")
+        if number != card.REST[len(self.state.players)]:
+            raise ValueError("A player has to discard as many cards as the rest.")
+        if unused - hand:
+            raise ValueError("A player can't discard a card he doesn't have.")
+
+        self.hand = hand - unused
         self.state.unused = unused
 
     def add_rest_to_hand(self):
@@ -138,6 +161,7 @@ class Player(object):
 
     @hand.setter
     def hand(self, hand):
+        # hand is a list of cards or a CardSet
         self.adaptor.set_list("hand", sorted(int(i) for i in hand))
 
     @property
@@ -172,6 +196,8 @@ class Player(object):
 
 class Phase(object):
 
+    __slots__ = ("state", "adaptor")
+
     def __init__(self, state):
         self.state = state
         self.adaptor = state.adaptor
@@ -209,7 +235,7 @@ class Phase(object):
     def is_finished(self):
         if self.did_napoleon_forces_win or self.did_allied_forces_win:
             return True
-        return sum([len(p.hand) for p in self.state.players]) == 0
+        return all(p.number_of_hand == 0 for p in self.state.players)
 
     @property
     def did_napoleon_forces_win(self):
@@ -236,20 +262,32 @@ class Phase(object):
 
 class GameState(object):
 
+    __slots__ = ("adaptor", "room_id", "phase", "_player_cache")
+
     def __init__(self, adaptor):
         self.adaptor = adaptor
         self.room_id = adaptor.room_id
         self.phase = Phase(self)
+        # players don't change while a snapshot is used
+        self._player_cache = {} if adaptor.is_snapshot else None
 
     def create_player(self, user_id):
         if user_id is None:
             raise ValueError("user_id must not be None")
 
+        cache = self._player_cache
+        if cache is not None and str(user_id) in cache:
+            return cache[str(user_id)]
+
         d = self.adaptor.get_dict("isAI", type=bool)
         if d.get(str(user_id)):  # b/c
-            return PlayerAI(user_id, self)
+            player = PlayerAI(user_id, self)
+        else:
+            player = PlayerHuman(user_id, self)
 
-        return PlayerHuman(user_id, self)
+        if cache is not None:
+            cache[player.user_id] = player
+        return player
 
     def flush(self):
         """
@@ -257,23 +295,27 @@ class GameState(object):
         """
         self.adaptor.flush()
 
-    def start(self, restart=False):
+    def start(self, restart=False, user_ids=None):
         """
         Distribute cards to each player and leave the rest of cards which napoleon can change
+        :user_ids: the player ids if the caller has read them,
+                   then the hands are written in one batch without reading the room
         """
-        if restart:
-            del self._passed_players
-
-        players = list(self.players)
-        number_of_players = len(players)
+        if user_ids is None:
+            user_ids = self.player_ids
+        number_of_players = len(user_ids)
         if number_of_players <= 2:
             raise ValueError
 
         hands, rest = card.deal(number_of_players)
-        self.rest = rest
-        for (p, h) in zip(players, hands):
-            p.hand = h
-            p.face = 0
+        with _batch(self) as state:
+            if restart:
+                del state._passed_players
+            state.rest = rest
+            for (user_id, h) in zip(user_ids, hands):
+                p = Player(user_id, state) if state is not self else self.create_player(user_id)
+                p.hand = h
+                p.face = 0
 
     def set_role(self, adjutant=None):
         """
@@ -289,13 +331,24 @@ class GameState(object):
                     role = Role.allied_forces
             p.role = role
 
+    @property
+    def player_ids(self):
+        return self.adaptor.get_list("player_ids", type=str)
+
     @property
     def players(self):
         l = []
-        for pid in self.adaptor.get_list("player_ids", type=str):
+        for pid in self.player_ids:
             l.append(self.create_player(user_id=pid))
         return l
 
+    @property
+    def version(self):
+        """
+        It is incremented every time an action is committed
+        """
+        return self.adaptor.get("version", type=int) or 0
+
     @property
     def _allied_forces(self):
         return [p for p in self.players if p.is_allied_forces]
@@ -418,6 +471,8 @@ class GameState(object):
 
 class PlayerHuman(Player):
 
+    __slots__ = ("user",)
+
     is_AI = False
 
     def __init__(self, user_id, state):
@@ -427,6 +482,8 @@ class PlayerHuman(Player):
 
 class PlayerAI(Player):
 
+    __slots__ = ("user", "_AI")
+
     is_AI = True
 
     def __init__(self, user_id, state):
@@ -1,9 +1,36 @@
-from django.test import TestCase, Client
+import asyncio
+import functools
+import io
+import os
+import random
+import types
+import unittest
+
+from tornado.ioloop import IOLoop
+from django.conf import settings
+from django.test import TestCase, Client, override_settings
 from django.core.urlresolvers import reverse
 from napoleon.game import state
 from napoleon.room.models import Room
+from napoleon.room.state import AI, User
 from napoleon.game import card
-from napoleon.game.adaptor import RedisAdaptor
+from napoleon.game import delta
+from napoleon.game import phase
+from napoleon.game.broadcast import Broadcast
+from napoleon.game.adaptor import (
+    RedisAdaptor, HashAdaptor, MemoryAdaptor, MemoryStore, ConflictError, transaction, migrate, scan_room_keys,
+    get_adaptor,
+)
+from napoleon.game.engine import GameEngine
+from napoleon.AI import executor
+from napoleon.game import async_adaptor
+from napoleon.game import benchmark
+from napoleon.game import loadtest
+from napoleon.game.queue import RoomQueue
+from napoleon.game.scheduler import AIScheduler, next_action
+from napoleon.game.session import Session, public_json, get_user_id, STATE, PLAYER
+from napoleon.game.metrics import Instrumented, Metrics, recording
+from napoleon.chat.handler import ChatHandler
 
 
 class DecideTestCase(TestCase):
@@ -54,6 +81,412 @@ class DecideTestCase(TestCase):
         assert card.decide([P(1, s), P(12, d), P(10, c)], c) == P(1, s)
 
 
+class CardTestCase(TestCase):
+
+    def test_from_int(self):
+        for i in range(1, card.NUMBER_OF_CARDS + 1):
+            c = card.from_int(i)
+            assert int(c) == i
+            assert c is card.from_int(i)
+        assert card.Plain(1, card.Suit.spade) is card.ALMIGHTY
+        assert card.from_list([1, 53]) == [card.Plain(1, card.Suit.club), card.Joker.red]
+
+    def test_hash(self):
+        d = {c: int(c) for c in card.deck}
+        assert len(d) == card.NUMBER_OF_CARDS
+        assert d[card.QUEEN] == int(card.QUEEN)
+        assert card.Joker.black in set(card.deck)
+
+    def test_immutable(self):
+        try:
+            card.ALMIGHTY.pip = 2
+        except AttributeError:
+            pass
+        else:
+            assert False
+        assert card.ALMIGHTY.pip == 1
+
+
+class CardSetTestCase(TestCase):
+
+    def test_membership(self):
+        P = card.Plain
+        c, d, h, s = list(card.Suit)
+        cs = card.CardSet([P(1, c), P(13, d), card.Joker.red])
+        assert P(1, c) in cs
+        assert P(1, d) not in cs
+        assert card.Joker.red in cs
+        assert card.Joker.black not in cs
+        assert len(cs) == 3
+        assert cs.number_of_faces == 2
+        assert list(cs) == [P(1, c), P(13, d), card.Joker.red]
+
+    def test_suit(self):
+        cs = card.CardSet(card.deck)
+        for s in card.Suit:
+            assert len(cs.of_suit(s)) == 13
+        assert list(cs.of_suit(None)) == list(card.Joker)
+        assert len(cs.faces) == card.NUMBER_OF_FACE_CARDS
+
+    def test_decide(self):
+        P = card.Plain
+        c, d, h, s = list(card.Suit)
+        board = [P(1, d), P(3, c), P(10, d)]
+        cs = card.CardSet(board)
+        assert card.decide(cs, c, lead=P(10, d)) == card.decide(board, c)
+
+    def test_possible_cards(self):
+        P = card.Plain
+        c, d, h, s = list(card.Suit)
+        hand = [P(2, d), P(5, h), card.Joker.black, P(11, s)]
+        expected = [P(2, d), card.Joker.black, P(11, s)]
+        assert card.possible_cards([P(1, d)], hand, c) == expected
+        assert list(card.possible_cards([P(1, d)], card.CardSet(hand), c)) == sorted(expected)
+        assert card.possible_cards([P(1, s)], hand, c) == [card.Joker.black, P(11, s)]
+        assert card.possible_cards([P(4, c)], hand, d) == hand
+
+
+class RankTableTestCase(TestCase):
+
+    rules = [
+        None,
+        {"same_two": False},
+        {"yoromeki": False},
+    ]
+
+    def _boards(self, number_of_boards=300):
+        r = random.Random(0)
+        for size in range(3, 8 + 1):
+            for _ in range(number_of_boards):
+                yield r.sample(range(1, card.NUMBER_OF_CARDS + 1), size)
+
+    def test_resolve(self):
+        # rank tables must give the same result as decide on 3 to 8 card boards
+        for values in self._boards():
+            cards = card.from_list(values)
+            for trump in card.Suit:
+                for is_first_round in [False, True]:
+                    for rule in self.rules:
+                        expected = card.decide(cards, trump, is_first_round, rule)
+                        got = card.resolve(values, trump, is_first_round, rule)
+                        assert got == int(expected), (values, trump, is_first_round, rule)
+
+    def test_resolve_same_two(self):
+        P = card.Plain
+        for trump in card.Suit:
+            for suit in card.Suit:
+                board = [P(2, suit), P(3, suit), P(10, suit)]
+                expected = card.decide(board, trump)
+                assert card.resolve([int(b) for b in board], trump) == int(expected)
+
+    def test_resolve_many(self):
+        boards = list(self._boards(50))
+        for trump in card.Suit:
+            expected = [int(card.decide(card.from_list(b), trump)) for b in boards]
+            assert card.resolve_many(boards, trump) == expected
+
+
+class BatchTestCase(TestCase):
+
+    def test_deal_many(self):
+        import numpy as np
+        from napoleon.game import batch
+        rng = np.random.default_rng(0)
+        for n in card.RANGE_OF_PLAYERS:
+            hands, rest = batch.deal_many(10, n, rng)
+            assert hands.shape[:2] == (10, n)
+            assert rest.shape == (10, card.REST[n])
+            for h, r in zip(hands, rest):
+                values = sorted(h.ravel().tolist() + r.tolist())
+                assert len(set(values)) == len(values)
+                assert set(values) <= set(range(1, card.NUMBER_OF_CARDS + 1))
+
+    def test_decide_and_winner(self):
+        import numpy as np
+        from napoleon.game import batch
+        rng = np.random.default_rng(0)
+        for n in card.RANGE_OF_PLAYERS:
+            hands, _ = batch.deal_many(500, n, rng)
+            boards = hands[:, :, 0]
+            leads = rng.integers(0, n, len(boards))
+            for trump in card.Suit:
+                for is_first_round in [False, True]:
+                    decided = batch.decide(boards, trump, is_first_round)
+                    won = batch.winner(boards, leads, trump, is_first_round)
+                    for b, lead, d, w in zip(boards.tolist(), leads, decided, won):
+                        assert d == card.resolve(b, trump, is_first_round)
+                        ordered = [v for i, v in enumerate(b) if i != lead] + [b[lead]]
+                        assert b[w] == card.resolve(ordered, trump, is_first_round)
+
+
+class DeltaTestCase(TestCase):
+
+    def test_patch(self):
+        old = {"version": 1, "board": [], "players": [{"face": 0, "hand": [1, 2]}, {"face": 1}], "turn": "1"}
+        new = {"version": 2, "board": [2], "players": [{"face": 0, "hand": [1]}, {"face": 1, "is_AI": True}]}
+        ops = delta.diff(old, new)
+        assert delta.patch(old, ops) == new
+        assert old["players"][0]["hand"] == [1, 2]
+        assert [["turn"]] in ops
+        assert delta.diff(new, new) == []
+        # a bool is not the same as an int
+        assert delta.diff({"a": 1}, {"a": True}) == [[["a"], True]]
+
+
+class BroadcastTestCase(TestCase):
+
+    def test_publish(self):
+        # each Broadcast stands for a process which has connections of the path
+        path = "/ws/broadcast_test"
+        processes = [Broadcast(), Broadcast()]
+        received = [[], []]
+
+        async def run():
+            done = asyncio.Event()
+            for b, r in zip(processes, received):
+                async def callback(path, message, r=r):
+                    r.append((path, message))
+                    if all(len(r) == 2 for r in received):
+                        done.set()
+                await b.subscribe(path, callback)
+            assert await processes[0].is_watched(path)
+            await processes[0].publish(path, {"version": 1})
+            await processes[1].publish(path)
+            await asyncio.wait_for(done.wait(), 5)
+            for b in processes:
+                await b.unsubscribe(path)
+            assert not await processes[0].is_watched(path)
+
+        IOLoop.current().run_sync(run)
+        assert received[0] == received[1] == [(path, {"version": 1}), (path, None)]
+
+    def test_notify(self):
+        path = "/ws/broadcast_test"
+        process = Broadcast()
+        received = []
+
+        async def run():
+            async def callback(path, message):
+                received.append(message)
+
+            await process.subscribe(path, callback)
+            # the notifications in one iteration are published once
+            await asyncio.gather(*[process.notify(path) for _ in range(3)])
+            await process.notify(path)
+            await asyncio.sleep(0.1)
+            await process.unsubscribe(path)
+
+        IOLoop.current().run_sync(run)
+        assert received == [None, None]
+
+    def test_slow_room(self):
+        process = Broadcast()
+        slow, fast = "/ws/broadcast_slow", "/ws/broadcast_fast"
+        received = []
+
+        async def run():
+            release = asyncio.Event()
+            written = asyncio.Event()
+
+            async def slow_callback(path, message):
+                await release.wait()
+                received.append((path, message))
+
+            async def fast_callback(path, message):
+                received.append((path, message))
+                written.set()
+
+            await process.subscribe(slow, slow_callback)
+            await process.subscribe(fast, fast_callback)
+            await process.publish(slow, 1)
+            await process.publish(slow, 2)
+            await process.publish(fast, 3)
+            # the other room is written while the slow one is blocked
+            await asyncio.wait_for(written.wait(), 5)
+            assert received == [(fast, 3)]
+            release.set()
+            for _ in range(50):
+                if len(received) == 3:
+                    break
+                await asyncio.sleep(0.1)
+            await process.unsubscribe(slow)
+            await process.unsubscribe(fast)
+
+        IOLoop.current().run_sync(run)
+        # the messages of a room keep their order
+        assert received == [(fast, 3), (slow, 1), (slow, 2)]
+
+
+class RoomQueueTestCase(TestCase):
+
+    def test_order(self):
+        queue = RoomQueue()
+        log = []
+
+        async def action(name):
+            log.append(name)
+            await asyncio.sleep(0.01)
+            log.append(name)
+
+        async def run():
+            await asyncio.gather(*[queue.run(room_id, action, room_id + name)
+                                   for name in "abc" for room_id in "12"])
+
+        IOLoop.current().run_sync(run)
+        # the actions of a room don't interleave, and the rooms run concurrently
+        for room_id in "12":
+            assert [n for n in log if n[0] == room_id] == [room_id + n for n in "aabbcc"]
+        assert log[:2] == ["1a", "2a"]
+        assert queue.locks == {}
+
+
+def play_game(get_state, take_action, r):
+    """
+    Play a game where the first player is napoleon and the cards are chosen by r
+    :get_state: a function which returns the state to read the game
+    :take_action: a function which takes user_id and json, and returns True if the action is taken
+    """
+    ids = [p.user_id for p in get_state().players]
+    assert take_action(ids[0], {"action": "start"})
+    declaration = card.Declaration(13, card.Suit.spade)
+    assert take_action(ids[0], {"action": "declare", "declaration": int(declaration)})
+    for uid in ids[1:]:
+        assert take_action(uid, {"action": "pass"})
+    assert get_state().phase.current == "adjutant"
+    assert take_action(ids[0], {"action": "adjutant", "adjutant": int(card.ALMIGHTY)})
+    s = get_state()
+    unused = [int(c) for c in s.create_player(ids[0]).hand[:len(s.rest)]]
+    assert take_action(ids[0], {"action": "discard", "unused": unused})
+    assert get_state().phase.current == "first_round"
+    while get_state().phase.current != "finished":
+        p = get_state().turn
+        assert take_action(p.user_id, {"action": "select", "selected": r.choice(p.possible_cards)})
+
+
+def join_room(adaptor, players=5):
+    """
+    :return: the ids of the players who have joined the room
+    """
+    user_ids = [str(i + 1) for i in range(players)]
+    for user_id in user_ids:
+        User(user_id, "session" + user_id, adaptor).join()
+    return user_ids
+
+
+def play_room(adaptor, r):
+    """
+    Play a game in a room where players have joined, taking every action in a transaction as the handlers do
+    """
+    def take_action(user_id, json):
+        return transaction(adaptor, lambda a: phase.take_action(state.GameState(a), user_id, json))
+
+    play_game(lambda: state.GameState(adaptor.snapshot()), take_action, r)
+
+
+def redis_only(test):
+    """
+    Skip a test of redis itself when the rooms are in memory
+    """
+    @functools.wraps(test)
+    def wrapper(self):
+        if getattr(settings, "REDIS_ROOM_LAYOUT", "keys") == "memory":
+            self.skipTest("the rooms are in memory")
+        return test(self)
+    return wrapper
+
+
+class EngineTestCase(TestCase):
+
+    def _play(self, engine, r):
+        play_game(lambda: engine, engine.take_action, r)
+
+    def test_full_game(self):
+        r = random.Random(0)
+        for n in card.RANGE_OF_PLAYERS:
+            engine = GameEngine([str(i) for i in range(n)])
+            self._play(engine, r)
+            faces = engine.number_of_face_cards_of_napoleon_forces + engine.number_of_face_cards_of_allied_forces
+            assert faces <= card.NUMBER_OF_FACE_CARDS
+            assert engine.phase.did_napoleon_forces_win or engine.phase.did_allied_forces_win
+
+    def test_clone_and_rollback(self):
+        engine = GameEngine(["a", "b", "c"])
+        engine.take_action("a", {"action": "start"})
+        checkpoint = engine.clone()
+        hand = engine.create_player("a").hand
+        assert engine.take_action("a", {"action": "declare", "declaration": 60})
+        assert engine.napoleon == "a"
+        assert checkpoint.napoleon is None
+
+        engine.rollback(checkpoint)
+        assert engine.napoleon is None
+        assert engine.phase.current == "declare"
+        assert engine.create_player("a").hand == hand
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_compare(self):
+        results = benchmark.run(number=1, redis=False)
+        assert [r[0] for r in results][-2:] == ["game in GameEngine", "game in MemoryAdaptor"]
+        # the cases without round trips have a ratio to the reference
+        assert all(ratio > 0 for _, _, _, ratio in results)
+        baseline = {name: {"round_trips": rt, "ratio": ratio} for name, rt, _, ratio in results}
+        assert not any(r[-1] for r in benchmark.compare(results, baseline))
+
+        name, _, _, ratio = results[0]
+        baseline[name] = {"round_trips": 0, "ratio": ratio / 2}
+        assert [r[0] for r in benchmark.compare(results, baseline, tolerance=0.5) if r[-1]] == [name]
+        assert not any(r[-1] for r in benchmark.compare(results, baseline, tolerance=1.5))
+        baseline[name] = {"round_trips": -1, "ratio": ratio}
+        assert [r[0] for r in benchmark.compare(results, baseline) if r[-1]] == [name]
+        # a new case has no baseline
+        assert not any(r[-1] for r in benchmark.compare(results, {}))
+
+    def test_baseline(self):
+        baseline = benchmark.load(benchmark.BASELINE)
+        out = io.StringIO()
+        # the tolerance is wide enough for a noisy machine, but not for losing an optimization
+        assert benchmark.main(number=20, tolerance=1.0, stdout=out) == [], out.getvalue()
+        # every case is checked by the baseline
+        assert len(out.getvalue().splitlines()) == len(baseline)
+        assert all(name in out.getvalue() for name in baseline)
+
+
+class ExecutorTestCase(TestCase):
+
+    def test_view(self):
+        engine = GameEngine(["a", "b", "c"], {"a": "Taro", "b": "Taro", "c": "Taro"})
+        assert engine.take_action("a", {"action": "start"})
+        assert engine.take_action("a", {"action": "declare", "declaration": 60})
+        seen = executor.to_engine(executor.view(engine, "b"), "b", "Taro")
+        assert seen.create_player("b").hand == engine.create_player("b").hand
+        assert seen.create_player("a").hand == []
+        assert seen.napoleon == "a"
+        assert seen.rest == []
+        assert seen.phase.current == "declare"
+
+    def test_process(self):
+        engine = GameEngine(["a", "b", "c"], {"a": "Taro", "b": "RandomMan", "c": "Taro"})
+        # every decision exceeds the budget
+        e = executor.Executor(budget=-1, processes=1)
+
+        async def play():
+            while engine.phase.current != "finished":
+                user_id, json = await e.next_action(engine)
+                assert engine.take_action(user_id, json)
+
+        IOLoop.current().run_sync(play, timeout=60)
+        assert e.heavy == {"Taro", "RandomMan"}
+        assert engine.phase.did_napoleon_forces_win or engine.phase.did_allied_forces_win
+
+        # a fallback move is taken after the timeout
+        e = executor.Executor(budget=-1, timeout=0, processes=1)
+        engine = GameEngine(["a", "b", "c"], {"a": "Taro", "b": "Taro", "c": "Taro"})
+        e.heavy.add("Taro")
+        assert IOLoop.current().run_sync(lambda: e.next_action(engine)) == ("a", {"action": "start"})
+
+
 class StateTestCase(TestCase):
     fixtures = ["user.yaml", "room.yaml"]
 
@@ -70,7 +503,7 @@ class StateTestCase(TestCase):
             self.player_clients.append(c)
 
         self.room = Room.objects.get(pk=1)
-        self.state = state.GameState(RedisAdaptor(self.room.id))
+        self.state = state.GameState(get_adaptor(self.room.id))
         self.url_join = reverse("napoleon.room.views.join", kwargs={"room_id": self.room.id})
         self.url_quit = reverse("napoleon.room.views.quit", kwargs={"room_id": self.room.id})
 
@@ -124,6 +557,365 @@ class StateTestCase(TestCase):
         p.decide(adjutant)
         assert self.state.adjutant == adjutant
 
+    def test_public_json(self):
+        self._test_adjutant()
+        adaptor = self.state.adaptor.snapshot()
+        public = public_json(adaptor)
+        assert all(p["hand"] == [] for p in public["players"])
+        assert public["rest"] == []
+
+        session_ids = list(adaptor.get_dict("map").values()) + ["audience"]
+        for sid in session_ids:
+            assert Session(adaptor, session_id=sid).to_json(public) == Session(adaptor, session_id=sid).state.to_json()
+
+    def test_schema(self):
+        self._test_adjutant()
+        adaptor = self.state.adaptor.snapshot()
+        user_dict = adaptor.get_dict("map")
+        napoleon = self.state.napoleon
+        for user_id, sid in user_dict.items():
+            d = Session(adaptor, session_id=sid).to_json()
+            assert sorted(d) == sorted(STATE.names)
+            assert (d["rest"] != []) == (user_id == napoleon)
+            for p in d["players"]:
+                assert sorted(p) == sorted(PLAYER.names)
+                assert p["is_valid"] == (p["user_id"] == user_id)
+                assert (p["hand"] != []) == (p["user_id"] == user_id)
+
+    def test_snapshot(self):
+        for c in self.player_clients:
+            assert c.post(self.url_join).status_code == 302
+
+        adaptor = self.state.adaptor.snapshot()
+        snapshot = state.GameState(adaptor)
+        snapshot.start()
+        hands = [p.hand for p in snapshot.players]
+        # nothing is written before commit
+        assert all(p.hand == [] for p in self.state.players)
+
+        adaptor.commit()
+        assert [p.hand for p in self.state.players] == hands
+        assert [p.face for p in self.state.players] == [0] * len(hands)
+        assert self.state.rest == snapshot.rest
+
+    def test_version(self):
+        for c in self.player_clients:
+            assert c.post(self.url_join).status_code == 302
+        version = self.state.version
+
+        a = self.state.adaptor.snapshot()
+        b = self.state.adaptor.snapshot()
+        state.GameState(a).start()
+        a.commit()
+        assert self.state.version == version + 1
+
+        # b was loaded before a was committed
+        state.GameState(b).start()
+        try:
+            b.commit()
+        except ConflictError:
+            pass
+        else:
+            assert False
+
+        transaction(self.state.adaptor, lambda adaptor: state.GameState(adaptor).start())
+        assert self.state.version == version + 2
+
+        # a member who quits is committed in one transaction
+        c = self.state.adaptor.snapshot()
+        state.GameState(c).phase.current = "declare"
+        assert self.player_clients[0].post(self.url_quit).status_code == 302
+        assert self.state.version == version + 3
+        with self.assertRaises(ConflictError):
+            c.commit()
+
+    @redis_only
+    def test_async_adaptor(self):
+        for c in self.player_clients:
+            assert c.post(self.url_join).status_code == 302
+        user_id = self.state.players[0].user_id
+        adaptor = async_adaptor.AsyncRedisAdaptor(self.room.id)
+
+        async def start():
+            snapshot = await adaptor.snapshot()
+            assert snapshot.get_list("player_ids") == await adaptor.get_list("player_ids")
+            return await async_adaptor.transaction(adaptor, lambda a: state.GameState(a).start() or True)
+
+        version = self.state.version
+        assert IOLoop.current().run_sync(start)
+        assert self.state.version == version + 1
+        assert all(p.hand for p in self.state.players)
+        assert IOLoop.current().run_sync(lambda: adaptor.with_user(user_id).get_list("hand")) != []
+
+        async def rem_dict():
+            await adaptor.set_dict("player_cards", 1, 2)
+            await adaptor.rem_dict("player_cards", 1)
+            return await adaptor.get_dict("player_cards")
+
+        assert IOLoop.current().run_sync(rem_dict) == {}
+
+        async def push_unique():
+            await asyncio.gather(*[adaptor.set_list("player_ids", user_id, delete=False) for _ in range(3)])
+            return await adaptor.get_list("player_ids")
+
+        assert IOLoop.current().run_sync(push_unique).count(user_id) == 1
+        # a blocking operation is not run on an async connection
+        with self.assertRaises(NotImplementedError):
+            adaptor.batch()
+
+    def test_sessions(self):
+        adaptor = self.state.adaptor
+        User("1", "a", adaptor).join()
+        assert get_user_id(adaptor, "a") == "1"
+        assert get_user_id(adaptor, "audience") is None
+
+        # the old session is invalidated
+        User("1", "b", adaptor).reset()
+        assert get_user_id(adaptor, "a") is None
+        assert get_user_id(adaptor.snapshot(), "b") == "1"
+
+        User("1", "b", adaptor).quit()
+        assert get_user_id(adaptor, "b") is None
+        assert adaptor.get_dict("sessions") == {}
+
+        # a player who has joined before the sessions index, with a player who joins after it
+        User("2", "c", adaptor).join()
+        adaptor.set_dict("map", "3", "legacy")
+        assert get_user_id(adaptor, "legacy") == "3"
+        assert get_user_id(adaptor, "c") == "2"
+
+        # a user id cached by a connection is checked against the room
+        snapshot = adaptor.snapshot()
+        assert Session.of_user(snapshot, "legacy", "3").is_valid
+        assert Session.of_user(snapshot, "c", "3") is None
+
+        # a connection looks up a sid without reading the whole room
+        handler = types.SimpleNamespace(adaptor=async_adaptor.get_adaptor(self.room.id))
+        handler.adaptor.conn = Instrumented(handler.adaptor.conn)
+        for sid, user_id in [("c", "2"), ("legacy", "3"), ("audience", None)]:
+            assert IOLoop.current().run_sync(lambda: ChatHandler.find_user_id(handler, sid)) == user_id
+        with recording() as record:
+            IOLoop.current().run_sync(lambda: ChatHandler.find_user_id(handler, "c"))
+        assert record.round_trips == 1
+
+    def test_scheduler(self):
+        assert self.player_clients[0].post(self.url_join).status_code == 302
+        for _ in range(2):
+            AI(self.state.adaptor).add("Taro")
+        human = [p for p in self.state.players if not p.is_AI][0]
+        assert phase.take_action(self.state, human.user_id, {"action": "start"})
+        declaration = int(card.Declaration(13, card.Suit.spade))
+        assert phase.take_action(self.state, human.user_id, {"action": "declare", "declaration": declaration})
+        adaptor = async_adaptor.get_adaptor(self.room.id)
+        scheduler = AIScheduler(delay=0)
+        changes = []
+
+        async def on_change():
+            changes.append(self.state.version)
+
+        IOLoop.current().run_sync(lambda: scheduler.wake(adaptor, on_change))
+        assert all(p.is_passed for p in self.state.player_AIs)
+        assert len(changes) == 2
+        assert scheduler.tasks == {}
+
+        # a failure ends the task of the room
+        async def fail():
+            raise RuntimeError
+
+        self.state.phase.current = "declare"
+        del self.state._passed_players
+        IOLoop.current().run_sync(lambda: scheduler.wake(adaptor, fail))
+        assert scheduler.tasks == {}
+
+    def test_fast_forward(self):
+        for name in ["Taro", "RandomMan", "Taro", "RandomMan"]:
+            AI(self.state.adaptor).add(name)
+        adaptor = async_adaptor.get_adaptor(self.room.id)
+        # a room of only AI players doesn't wait
+        scheduler = AIScheduler(delay=60, batch=20)
+        changes = []
+
+        async def on_change():
+            changes.append(self.state.version)
+
+        IOLoop.current().run_sync(lambda: scheduler.wake(adaptor, on_change), timeout=10)
+        assert self.state.phase.current == "finished"
+        assert 1 < len(changes) < 10
+
+    def test_watched_room(self):
+        for name in ["Taro", "RandomMan", "Taro", "RandomMan"]:
+            AI(self.state.adaptor).add(name)
+        adaptor = async_adaptor.get_adaptor(self.room.id)
+        scheduler = AIScheduler(delay=0, batch=20)
+        changes = []
+
+        async def on_change():
+            changes.append(self.state.version)
+
+        async def is_watched():
+            return True
+
+        # a viewer follows every action
+        IOLoop.current().run_sync(lambda: scheduler.wake(adaptor, on_change, is_watched), timeout=10)
+        assert self.state.phase.current == "finished"
+        assert len(changes) > 20
+
+    @redis_only
+    def test_flush(self):
+        for c in self.player_clients:
+            assert c.post(self.url_join).status_code == 302
+        self.state.start()
+        # the keys of a player who has quit are deleted too
+        assert self.player_clients[0].post(self.url_quit).status_code == 302
+
+        self.state.flush()
+        assert scan_room_keys(self.state.adaptor.conn, self.room.id) == []
+
+    @redis_only
+    def test_batch(self):
+        for c in self.player_clients:
+            assert c.post(self.url_join).status_code == 302
+        conn = Instrumented(self.state.adaptor.conn)
+        s = state.GameState(RedisAdaptor(self.room.id, conn=conn, timer=60))
+        user_ids = s.player_ids
+        with recording() as record:
+            s.start(user_ids=user_ids)
+        # the cards are written in one batch
+        assert record.round_trips == 1
+        hands = [p.hand for p in s.players]
+        assert sum(len(h) for h in hands) + len(s.rest) == card.NUMBER_OF_CARDS
+        assert all(p.face == 0 for p in s.players)
+        assert 0 < conn.ttl(s.players[0].adaptor.key("hand")) <= 60
+
+        # a unique value is pushed once, and the list expires in the same round trip
+        # (the script is loaded by the first call)
+        s.adaptor.set_list("player_ids", user_ids[0], delete=False)
+        with recording() as record:
+            s.adaptor.set_list("player_ids", user_ids[0], delete=False)
+        assert record.round_trips == 1
+        assert s.adaptor.get_list("player_ids") == user_ids
+        assert 0 < conn.ttl(s.adaptor.key("player_ids")) <= 60
+        with recording() as record:
+            s.adaptor.set_list("unused", [1, 2])
+        assert record.round_trips == 1
+        assert 0 < conn.ttl(s.adaptor.key("unused")) <= 60
+
+    @redis_only
+    def test_round_trips(self):
+        for name in ["RandomMan"] * 4:
+            AI(self.state.adaptor).add(name)
+        adaptor = RedisAdaptor(self.room.id, conn=Instrumented(self.state.adaptor.conn))
+        metrics = Metrics()
+        while True:
+            action = next_action(state.GameState(adaptor.snapshot()))
+            if not action:
+                break
+            user_id, json = action
+            with metrics.measure("action", phase.action_name(json["action"])) as record:
+                assert transaction(adaptor, lambda a: phase.take_action(state.GameState(a), user_id, json))
+            # loading a snapshot (2) and committing it (3) whatever the action is
+            assert record.round_trips <= 5, (json, record.round_trips)
+        assert self.state.phase.current == "finished"
+        actions = metrics.to_json()["action"]
+        assert set(actions) == {"start", "declare", "pass", "adjutant", "discard", "select"}
+        assert actions["pass"]["calls"] == 3
+        # a client can't add a name to the metrics
+        assert phase.action_name("DECLARE") == "declare"
+        assert {phase.action_name(name) for name in [None, "", "x" * 100, "action", "__class__"]} == {"invalid"}
+
+        # a broadcast reads the room once for any number of viewers
+        with recording() as record:
+            snapshot = adaptor.snapshot()
+            public = public_json(snapshot)
+            for i in range(10):
+                Session(snapshot, session_id="session%d" % i).to_json(public)
+        assert record.round_trips <= 2
+
+    @redis_only
+    def test_hash_layout(self):
+        for c in self.player_clients:
+            assert c.post(self.url_join).status_code == 302
+        self.state.start()
+        players = [(p.user_id, p.hand, p.face) for p in self.state.players]
+
+        assert migrate(self.room.id)
+        assert not migrate(self.room.id)
+        hashed = state.GameState(HashAdaptor(self.room.id))
+        assert [(p.user_id, p.hand, p.face) for p in hashed.players] == players
+        assert self.state.players == []
+
+        transaction(hashed.adaptor, lambda adaptor: state.GameState(adaptor).players[0].pass_())
+        assert [p.user_id for p in hashed._passed_players] == [players[0][0]]
+        hashed.flush()
+
+    def test_memory_layout(self):
+        store = MemoryStore()
+        adaptor = MemoryAdaptor(self.room.id, conn=store)
+        join_room(adaptor)
+        version = state.GameState(adaptor).version
+        b = adaptor.snapshot()
+        play_room(adaptor, random.Random(0))
+        s = state.GameState(adaptor)
+        assert s.phase.current == "finished"
+        assert s.version > version
+
+        # b was loaded before the game
+        state.GameState(b).start()
+        with self.assertRaises(ConflictError):
+            b.commit()
+
+        # a key expires as on redis
+        a = MemoryAdaptor("memory", conn=store, timer=60)
+        a.set_list("player_ids", [1, 2])
+        a.set_list("player_ids", 2, delete=False)
+        a.set_dict("player_cards", 1, 3)
+        assert a.get_list("player_ids", type=int) == [2, 1]
+        assert a.get_dict("player_cards", type=int) == {"1": 3}
+        a.expire("player_ids", 0)
+        assert a.get_list("player_ids") == []
+
+        async def chat():
+            a = async_adaptor.AsyncMemoryAdaptor("memory", conn=store)
+            await a.set_list("chat_messages", "hi", delete=False, unique=False)
+            return await a.get_list("chat_messages")
+
+        assert IOLoop.current().run_sync(chat) == ["hi"]
+        with self.assertRaises(NotImplementedError):
+            async_adaptor.AsyncMemoryAdaptor("memory", conn=store).batch()
+        adaptor.flush()
+        a.flush()
+        # only the user keys which are shared among rooms are left
+        assert all(key.startswith("user_") for key in store.data)
+
+    def test_play_card(self):
+        self._test_declare()
+
+        a = self.state.adaptor.snapshot()
+        b = self.state.adaptor.snapshot()
+        p = state.GameState(a).players[0]
+        c = p.possible_cards[0]
+        p.select(c)
+        a.commit()
+
+        # b was loaded before the card was played
+        state.GameState(b).players[0].select(c)
+        with self.assertRaises(ConflictError):
+            b.commit()
+        assert self.state.board == [c]
+        assert self.state.player_cards == {p.user_id: c}
+        assert c not in self.state.players[0].hand
+
+    def test_select(self):
+        self._test_declare()
+
+        # a card is played on the room without a snapshot
+        p = self.state.players[0]
+        hand = p.hand
+        c = p.possible_cards[0]
+        p.select(c)
+        assert self.state.board == [c]
+        assert sorted(self.state.players[0].hand) == sorted(h for h in hand if h != c)
+
     def test_discard(self):
         self._test_adjutant()
 
@@ -136,6 +928,29 @@ class StateTestCase(TestCase):
         unused = p.hand[:num]  # discards cards from last to last but 6th
         hand = p.hand[num:] + self.state.rest
         p.add_rest_to_hand()
+        # the same card twice, and a wrong number of cards
+        for cards in [unused[:-1] + unused[:1], unused[:-1], unused + hand[:1]]:
+            with self.assertRaises(ValueError):
+                p.discard(cards)
+        assert sorted(p.hand) == sorted(unused + hand)
         p.discard(unused)
         assert unused == self.state.unused
         assert sorted(hand) == sorted(p.hand)
+
+
+@override_settings(REDIS_ROOM_LAYOUT="memory")
+class MemoryStateTestCase(StateTestCase):
+    """
+    The same tests with the rooms in MemoryAdaptor
+    """
+
+
+@unittest.skipUnless(os.environ.get("NAPOLEON_LOADTEST"), "set NAPOLEON_LOADTEST=1 to start a tornado server")
+class LoadTestCase(TestCase):
+
+    def test_loadtest(self):
+        report = loadtest.run(rooms=2, humans=1, AIs=2, port=0, timeout=60, chat_every=3)
+        assert report["rooms_finished"] == 2
+        assert report["actions_per_second"] > 0
+        assert report["latency_ms"][50] <= report["latency_ms"][99]
+        assert report["chat_latency_ms"][50] is not None
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from napoleon.game import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Measure round trips to redis and CPU time of the card engine and a room'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=50, help="Specify the number of calls")
+        parser.add_argument('--save', help="Save the results as a baseline to the path")
+        parser.add_argument('--compare', default=benchmark.BASELINE,
+                            help="Compare the results with a baseline of the path")
+        parser.add_argument('--tolerance', type=float, default=benchmark.TOLERANCE,
+                            help="Specify the ratio of CPU time over a baseline which is a regression")
+        parser.add_argument('--no-redis', action='store_true', help="Run only the cases in memory")
+
+    def handle(self, *args, **options):
+        regressions = benchmark.main(
+            number=options["number"],
+            redis=not options["no_redis"],
+            save_to=options["save"],
+            baseline=options["compare"],
+            tolerance=options["tolerance"],
+            stdout=self.stdout,
+        )
+        if regressions:
+            raise CommandError("Regressions: %s" % ", ".join(regressions))
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from napoleon.game.adaptor import flush_orphans
+from napoleon.room.models import Room
+
+
+class Command(BaseCommand):
+    help = 'Delete redis keys of finished rooms with SCAN'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', nargs="*", default=None, help="Specify room ids")
+
+    def handle(self, *args, **options):
+        room_ids = options["room"]
+        if room_ids is None:
+            room_ids = Room.objects.filter(finished=True).values_list("id", flat=True)
+        count = 0
+        for room_id in room_ids:
+            count += flush_orphans(settings.REDIS_CONNECTION, room_id)
+        self.stdout.write('Successfully delete %d keys' % count)
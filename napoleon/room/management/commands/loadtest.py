@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from napoleon.game import loadtest
+
+
+class Command(BaseCommand):
+    help = 'Play many rooms at once over websockets on a local redis and report the throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10, help="Specify the number of rooms")
+        parser.add_argument('--humans', type=int, default=2, help="Specify the number of human players in a room")
+        parser.add_argument('--AIs', type=int, default=3, help="Specify the number of AI players in a room")
+        parser.add_argument('--AI-name', action='append', dest='AI_names', help="Specify the AI names")
+        parser.add_argument('--AI-delay', type=float, default=0, help="Specify seconds an AI player waits")
+        parser.add_argument('--chat-every', type=int, default=5,
+                            help="Specify the number of actions between chat messages, or 0")
+        parser.add_argument('--port', type=int, default=8765, help="Specify a port for tornado")
+        parser.add_argument('--timeout', type=int, default=300, help="Specify seconds to give up")
+        parser.add_argument('--seed', type=int, default=0, help="Specify a seed of the random players")
+
+    def handle(self, *args, **options):
+        report = loadtest.run(
+            rooms=options["rooms"],
+            humans=options["humans"],
+            AIs=options["AIs"],
+            AI_names=options["AI_names"] or ["RandomMan"],
+            port=options["port"],
+            timeout=options["timeout"],
+            seed=options["seed"],
+            chat_every=options["chat_every"],
+            AI_delay=options["AI_delay"],
+        )
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
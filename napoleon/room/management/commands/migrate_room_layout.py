@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from napoleon.game.adaptor import migrate
+
+
+class Command(BaseCommand):
+    help = 'Move rooms from the key layout to the hash layout of redis'
+
+    def handle(self, *args, **options):
+        conn = settings.REDIS_CONNECTION
+        count = 0
+        for key in conn.scan_iter(match="*_player_ids"):
+            room_id = key.decode("utf-8")[:-len("_player_ids")]
+            if migrate(room_id, conn=conn):
+                count += 1
+        self.stdout.write('Successfully migrate %d rooms' % count)
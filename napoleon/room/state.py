@@ -1,8 +1,12 @@
 import uuid
-from napoleon.game.adaptor import RedisAdaptor
+from napoleon.game.adaptor import RedisAdaptor, transaction
 
 
 class User(object):
+    """
+    The changes of a member are committed in one transaction,
+    which increments the version of the room.
+    """
 
     def __init__(self, user_id, session_id, adaptor):
         """
@@ -13,22 +17,42 @@ class User(object):
         self.session_id = session_id
 
     def join(self, user=None):
-        self.adaptor.set_list("player_ids", self.user_id, delete=False)
-        self.adaptor.set_dict("map", self.user_id, self.session_id)
-        self.adaptor.set_dict("isAI", self.user_id, False)
+        username = user and user.get_username() or "ANONYMOUS USER"
+        # flush() deletes the keys of the user even if the transaction is retried
+        self.adaptor.register()
+        transaction(self.adaptor, lambda adaptor: self._join(adaptor, username))
+
+    def _join(self, adaptor, username):
+        adaptor.set_list("player_ids", self.user_id, delete=False)
+        self._set_session(adaptor)
+        adaptor.set_dict("isAI", self.user_id, False)
 
         # TODO: define a user dict and reduce a code
-        self.adaptor.set_dict("user", "username", user and user.get_username() or "ANONYMOUS USER")
-        self.adaptor.set_dict("user", "user_id", self.user_id)
+        adaptor.set_dict("user", "username", username)
+        adaptor.set_dict("user", "user_id", self.user_id)
 
     def quit(self):
-        self.adaptor.rem_list("player_ids", self.user_id)
-        self.adaptor.rem_dict("map", self.user_id)
-        self.adaptor.delete("user")
+        transaction(self.adaptor, self._quit)
+
+    def _quit(self, adaptor):
+        adaptor.rem_list("player_ids", self.user_id)
+        self._rem_session(adaptor)
+        adaptor.delete("user")
 
     def reset(self):
-        self.adaptor.rem_dict("map", self.user_id)
-        self.adaptor.set_dict("map", self.user_id, self.session_id)
+        transaction(self.adaptor, self._set_session)
+
+    def _set_session(self, adaptor):
+        # the old session id of the user can't be used any more
+        self._rem_session(adaptor)
+        adaptor.set_dict("map", self.user_id, self.session_id)
+        adaptor.set_dict("sessions", self.session_id, self.user_id)
+
+    def _rem_session(self, adaptor):
+        session_id = adaptor.get_dict_item("map", self.user_id)
+        if session_id:
+            adaptor.rem_dict("sessions", session_id)
+        adaptor.rem_dict("map", self.user_id)
 
 
 class AI(object):
@@ -41,11 +65,18 @@ class AI(object):
         self.adaptor = RedisAdaptor.create(adaptor, self.user_id)
 
     def add(self, name):
-        self.adaptor.set_list("player_ids", self.user_id, delete=False)
-        self.adaptor.set_dict("AI", "user_id", self.user_id)
-        self.adaptor.set_dict("AI", "username", name)
-        self.adaptor.set_dict("isAI", self.user_id, True)
+        self.adaptor.register()
+        transaction(self.adaptor, lambda adaptor: self._add(adaptor, name))
+
+    def _add(self, adaptor, name):
+        adaptor.set_list("player_ids", self.user_id, delete=False)
+        adaptor.set_dict("AI", "user_id", self.user_id)
+        adaptor.set_dict("AI", "username", name)
+        adaptor.set_dict("isAI", self.user_id, True)
 
     def remove(self, user_id):
-        self.adaptor.rem_dict("AI", user_id)
-        self.adaptor.rem_list("player_ids", user_id)
+        transaction(self.adaptor, lambda adaptor: self._remove(adaptor, user_id))
+
+    def _remove(self, adaptor, user_id):
+        adaptor.rem_dict("AI", user_id)
+        adaptor.rem_list("player_ids", user_id)
@@ -10,7 +10,7 @@ from django.shortcuts import render, redirect, get_object_or_404
 
 from napoleon.game import card
 from napoleon.game import session
-from napoleon.game.adaptor import RedisAdaptor
+from napoleon.game.adaptor import get_adaptor
 from napoleon.AI import ai_names
 
 from . import models
@@ -72,7 +72,12 @@ def game_state(request, room_id):
     else:
         room_id = sid = uid = request.COOKIES["user_session"]
         timer = settings.GAME_TIME_FOR_ANONYMOUS_PLAYER
-    s = session.Session(RedisAdaptor(room_id, timer=timer), sid, uid)
+    s = session.Session(get_adaptor(room_id, timer=timer), sid, uid)
+
+    # a client doesn't need to refresh the state if it has the current version
+    version = request.GET.get("version")
+    if version and version.isdigit() and int(version) == s.myself.state.version:
+        return JsonResponse({"state": None, "version": int(version)})
     return JsonResponse({"state": s.myself.state.to_json()})
 
 
@@ -107,21 +112,21 @@ def _get_user_state(request, adaptor):
 @login_required
 @require_http_methods(["POST"])
 def join(request, room_id):
-    _get_user_state(request, adaptor=RedisAdaptor(room_id)).join(request.user)
+    _get_user_state(request, adaptor=get_adaptor(room_id)).join(request.user)
     return redirect("napoleon.room.views.detail", game_id=room_id)
 
 
 @login_required
 @require_http_methods(["POST"])
 def quit(request, room_id):
-    _get_user_state(request, adaptor=RedisAdaptor(room_id)).quit()
+    _get_user_state(request, adaptor=get_adaptor(room_id)).quit()
     return redirect("napoleon.room.views.detail", game_id=room_id)
 
 
 @login_required
 @require_http_methods(["POST"])
 def reset(request, room_id):
-    _get_user_state(request, adaptor=RedisAdaptor(room_id)).reset()
+    _get_user_state(request, adaptor=get_adaptor(room_id)).reset()
     return redirect("napoleon.room.views.detail", game_id=room_id)
 
 
@@ -129,13 +134,13 @@ def reset(request, room_id):
 @require_http_methods(["POST"])
 def add(request, room_id):
     name = request.POST["name"]
-    state.AI(RedisAdaptor(room_id)).add(name)
+    state.AI(get_adaptor(room_id)).add(name)
     return redirect("napoleon.room.views.detail", game_id=room_id)
 
 
 def play(request):
     room_id = sid = uid = "anonymous_%s" % str(random.randint(10 ** 6, 10 ** 7))
-    adaptor = RedisAdaptor(room_id, timer=settings.GAME_TIME_FOR_ANONYMOUS_PLAYER)
+    adaptor = get_adaptor(room_id, timer=settings.GAME_TIME_FOR_ANONYMOUS_PLAYER)
     user_state = state.User(user_id=uid, session_id=sid, adaptor=adaptor)
     user_state.join()
 
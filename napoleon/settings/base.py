@@ -124,13 +124,50 @@ def get_connection(host="localhost", port=6379, db=0):
     else:
         return redis.from_url(uri)
 
+def get_async_connection(host="localhost", port=6379, db=0, max_connections=None):
+    # the tornado handlers share a connection pool which doesn't block the IOLoop
+    import redis.asyncio
+
+    uri = os.environ.get("REDISTOGO_URL")
+    if not uri:
+        return redis.asyncio.Redis(host, port=port, db=db, max_connections=max_connections)
+    else:
+        return redis.asyncio.from_url(uri, max_connections=max_connections)
+
 # On heroku the number of connections is limited.
 # For now, use only one redes connection.
 # What problems happend?
 REDIS_CONNECTION = get_connection()
 
+REDIS_ASYNC_MAX_CONNECTIONS = 10
+
+REDIS_ASYNC_CONNECTION = get_async_connection(max_connections=REDIS_ASYNC_MAX_CONNECTIONS)
+
+# "keys": a redis key per value of a room
+# "hash": a room in one hash (run migrate_room_layout before switching)
+# "memory": the rooms in this process without redis, for tests and a single process
+REDIS_ROOM_LAYOUT = "keys"
+
 REDIS_CHAT_EXPRITE_TIME = 60 * 10
 
 REDIS_CHAT_LENGTH = 10
 
+# record the round trips to redis per action, phase and broadcast on /metrics,
+# which has no authentication, so turn it on only in a private network
+REDIS_METRICS = False
+
 TORNADO_PORT = 80
+
+# seconds an AI player waits before each action
+AI_DELAY = 1
+
+# the number of actions written at once in a room of only AI players
+AI_FAST_FORWARD_BATCH = 50
+
+# an AI class whose decision takes more CPU seconds than this decides in a process
+AI_DECISION_BUDGET = 0.05
+
+# seconds to wait for a decision in a process before a fallback move
+AI_DECISION_TIMEOUT = 5
+
+AI_PROCESSES = 2
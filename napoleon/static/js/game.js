@@ -6,7 +6,7 @@ app.config(function($interpolateProvider) {
 });
 
 app.controller("GameController", ["$scope", function($scope){
-    var wsGame = new WebSocket(urls.room);
+    var wsGame;
     var self = this;
     self.is_error = false;
     self.is_close = false;
@@ -19,7 +19,20 @@ app.controller("GameController", ["$scope", function($scope){
     // When a player sends data to a server, he can't select any before he gets its response.
     self.disabled = false;
 
-    this.update = function(state){
+    // the last state from the websocket which a patch is applied to
+    self.raw = null;
+
+    // is_patch is true if the state is a patch applied to the last one
+    this.update = function(state, is_patch){
+        // the state has not changed since the last update.
+        // a whole state of a lower version is of a room which has been reset, so it is shown
+        if (self.state && (state.version == self.state.version ||
+                           (is_patch && state.version < self.state.version))){
+            self.disabled = false;
+            $scope.$apply();
+            return;
+        }
+
         var myself = _.find(state.players, (function(p){
             return p.user_id == user_id;
         }));
@@ -33,14 +46,41 @@ app.controller("GameController", ["$scope", function($scope){
         $scope.$apply();
     };
 
+    // the state is null if this version is still the current one
+    this.refresh = function(){
+        $.get(urls.state, {version: self.state && self.state.version}, function(data){
+            if (data.state === null){
+                self.disabled = false;
+                $scope.$apply();
+                return;
+            }
+            self.update(data.state);
+        });
+    };
+
     // shoud update at init
-    $.get(urls.state, {}, function(data){
-        self.update(data.state);
-    });
+    self.refresh();
+
+    // a message is the whole state or a patch against the last one
+    this.receive = function(message){
+        var is_patch = message.patch !== undefined;
+        if (!is_patch){
+            self.raw = message;
+        } else if (self.raw && self.raw.version == message.base){
+            self.raw = patch(self.raw, message.patch);
+        } else {
+            // a state has been missed, so the server sends the whole state
+            self.raw = null;
+            self.send();
+            return;
+        }
+        // update() and the actions change the state
+        self.update($.extend(true, {}, self.raw), is_patch);
+    };
 
-    wsGame = new WebSocket(urls.room);
+    wsGame = new WebSocket(urls.room + "?delta=1");
     wsGame.onmessage = function (evt) {
-        self.update(JSON.parse(evt.data));
+        self.receive(JSON.parse(evt.data));
     };
     wsGame.onerror = function(err){  // when is this called?
         self.is_error = true;
@@ -53,6 +93,7 @@ app.controller("GameController", ["$scope", function($scope){
         if (json === undefined)
             json = {};
         json.session_id = $.cookie("sessionid") || $.cookie("user_session");
+        json.version = self.raw ? self.raw.version : null;
         wsGame.send(JSON.stringify(json));
         self.disabled = true;
     };
@@ -136,4 +177,21 @@ app.controller("GameController", ["$scope", function($scope){
         if (i >= 0)
             list.splice(i, 1);
     }
+
+    // the same as napoleon.game.delta.patch
+    function patch(state, ops){
+        var root = {"state": $.extend(true, {}, state)};
+        _.each(ops, function(op){
+            var path = ["state"].concat(op[0]);
+            var parent = root;
+            for (var i = 0; i < path.length - 1; i++)
+                parent = parent[path[i]];
+            var key = path[path.length - 1];
+            if (op.length == 1)
+                delete parent[key];
+            else
+                parent[key] = op[1];
+        });
+        return root.state;
+    }
 }]);